@@ -18,8 +18,11 @@ import socket
 
 import archiver.protocol
 import archiver.database
+import archiver.actors
+import archiver.monitor
+import archiver.policy
 import archiver.web
-from archiver.utils import getEnvPath, LevelFileLogObserver
+from archiver.utils import getEnvPath, createTmpPath, LevelFileLogObserver
 import logging
 from twisted.python.logfile import LogFile
 
@@ -47,10 +50,7 @@ def startServer(options):
     options.cmdPath = getEnvPath(options.cmdPath)
 
     print('Running',__file__,'as PID',info.pid)
-    if 'PID' in options.tmpPath:
-        options.tmpPath = options.tmpPath.replace('PID','%d') % info.pid
-    assert not os.path.exists(options.tmpPath)
-    os.makedirs(options.tmpPath)
+    options.tmpPath = createTmpPath(options.tmpPath,info.pid)
     print('Starting archive server with output to',options.tmpPath)
 
     # start logging all stdout and stderr traffic
@@ -70,14 +70,30 @@ def startServer(options):
     # startup the database
     archiver.protocol.MessageReceiver.options = options
     archiver.database.init(options)
+    archiver.policy.init(options.storePolicy)
+    
+    # parse and validate replies in worker threads?
+    if options.ingestThreads > 0:
+        archiver.protocol.ReplyReceiver.startWorkers(options.ingestThreads)
     
     # define a periodic timer interrupt handler
-    def ping():
-        archiver.database.ping(options)
-    pinger = task.LoopingCall(ping)
+    pinger = task.LoopingCall(archiver.database.ping)
     if options.pingInterval > 0:
         pinger.start(options.pingInterval)
 
+    # are we a worker process fed with replies by a front process?
+    if options.shardIndex >= 0:
+        from twisted.internet import stdio
+        archiver.actors.Actor.readOnly = True
+        reactor.callWhenRunning(
+            lambda: stdio.StandardIO(archiver.protocol.ShardReceiver()))
+        reactor.run()
+        return
+
+    # are we forwarding replies to worker processes?
+    if options.shards > 0:
+        startShards(options)
+
     # configure and start the reactor event loop
     try:
         # listen for clients sending reply messages
@@ -130,6 +146,34 @@ def startServer(options):
         raise
 
 
+def startShards(options):
+    """
+    Starts worker processes that each own the keyword tables of a subset of actors
+
+    This process continues to record reply_raw and the actors table, and
+    forwards each reply to the worker that owns its actor.
+    """
+    from twisted.internet import reactor
+    shards = [ ]
+    for index in range(options.shards):
+        args = [sys.executable,os.path.abspath(__file__)] + sys.argv[1:] + [
+            '--shard-index',str(index),
+            '--tmp-path',os.path.join(options.tmpPath,'shard%d-PID' % index)]
+        shards.append(archiver.protocol.ShardProcess(index,args,os.environ))
+    archiver.protocol.ReplyReceiver.shards = shards
+    # our workers record keyword values without reporting them back to us
+    archiver.monitor.enabled = False
+    def spawn(ignored):
+        for shard in shards:
+            shard.start()
+    # wait for the core tables to exist so that our workers do not also create them
+    reactor.callWhenRunning(
+        lambda: archiver.database.coreTablesReady().addCallback(spawn))
+    def stop():
+        for shard in shards:
+            shard.stop()
+    reactor.addSystemEventTrigger('before','shutdown',stop)
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv[1:]
@@ -178,10 +222,55 @@ def main(argv=None):
         help='Buffer size for reply message header database table')
     cli.add_option('--key-buffer-size',dest='keyBufferSize',type='int',default=10,
         help='Buffer size for reply keyword database tables')
+    cli.add_option('--copy-format',dest='copyFormat',choices=('csv','binary'),default='csv',
+        help='format of buffered rows copied into the database (binary needs postgres)')
+    cli.add_option('--buffer-mode',dest='bufferMode',choices=('memory','file'),
+        default='memory',
+        help='buffer rows in memory or spool them to files under TMPPATH (memory needs postgres)')
+    cli.add_option('--group-commit',dest='groupCommit',type='float',default=0,
+        help='load tables flushed within GROUPCOMMIT seconds in one transaction (0 to disable)')
+    cli.add_option('--flush-latency',dest='flushLatency',type='float',default=0,
+        help='adapt buffer sizes to the rows each table receives in FLUSHLATENCY seconds ' +
+        '(0 to use fixed buffer sizes)')
+    cli.add_option('--min-buffer-size',dest='minBufferSize',type='int',default=1,
+        help='smallest adaptive buffer size')
+    cli.add_option('--max-buffer-size',dest='maxBufferSize',type='int',default=1000,
+        help='largest adaptive buffer size')
+    cli.add_option('--max-flushes',dest='maxFlushes',type='int',default=1,
+        help='number of buffer loads each table can have in flight at once')
+    cli.add_option('--buffer-limit',dest='bufferLimit',type='int',default=100000,
+        help='rows a table can buffer while its loads are in flight before spilling to disk')
+    cli.add_option('--max-queued',dest='maxQueued',type='int',default=100,
+        help='buffers a table can queue before it stops spilling and, after buffering ' +
+        'twice buffer-limit rows, drops rows')
+    cli.add_option('--ingest-threads',dest='ingestThreads',type='int',default=0,
+        help='number of threads that parse and validate replies (0 to use the reactor thread; ' +
+        'measure with examples/ingestBenchmark.py before enabling)')
+    cli.add_option('--keyword-cache',dest='keywordCache',type='int',default=10000,
+        help='number of validated keyword values to cache (0 to validate every keyword)')
+    cli.add_option('--store-policy',dest='storePolicy',default='',
+        help='keyword storage policy rules, e.g. "tcc.*=onchange mcp.aliveAt=every:60 ' +
+        'tcc.axePos=deadband:1%" (policies are always, onchange, deadband:X[%] and every:SECS)')
+    cli.add_option('--rollups',dest='rollups',default='',
+        help='comma-separated bucket widths of the rollup tables to maintain for ' +
+        'numeric keywords, e.g. 1m,1h (whole numbers of s,m,h or d)')
+    cli.add_option('--query-cache',dest='queryCache',type='float',default=64,
+        help='megabytes of settled key table rows to cache for browsing (0 to disable)')
+    cli.add_option('--cache-chunk',dest='cacheChunk',type='float',default=3600,
+        help='seconds of key table rows in each cached chunk')
+    cli.add_option('--columnar-decode',dest='columnarDecode',action='store_true',default=False,
+        help='decode streamed query results into numpy columns (requires numpy)')
+    cli.add_option('--shards',dest='shards',type='int',default=0,
+        help='number of worker processes that record keywords, sharded by actor ' +
+        '(0 to record everything in this process)')
+    cli.add_option('--shard-index',dest='shardIndex',type='int',default=-1,
+        help='run as the worker process with this index (used internally by --shards)')
     cli.add_option('--trace-list',dest='traceList',default='',
         help='comma-separated list of tables for activity tracing')
+    cli.add_option('--max-age',dest='maxAge',type='float',
+        help='flush buffered rows no later than MAXAGE seconds after they are recorded')
     cli.add_option('--idle-time',dest='idleTime',type='float',
-        help='flush tables after no activity for IDLETIME (seconds)')
+        help='deprecated alias for --max-age')
     cli.add_option('--hub-initial-delay',dest='hubInitialDelay',type='float',
         help='initial delay before attempting to reconnect to hub (seconds)')
     cli.add_option('--hub-delay-factor',dest='hubDelayFactor',type='float',
@@ -192,6 +281,9 @@ def main(argv=None):
         help='Does system clock track UTC or TAI?')
         
     (options,args) = cli.parse_args(argv)
+    # configs that still set the deprecated idle-time keep their flush bound
+    if options.maxAge is None and options.idleTime is not None:
+        options.maxAge = options.idleTime
 
     startServer(options)
 
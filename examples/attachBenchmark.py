@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""
+Measures the cost of KeyTable.attach with and without its per-key cache
+
+Attaches the same keyword table repeatedly without any database engine,
+first after clearing the table cached in the key (so that every call runs
+the full attach logic, as it used to) and then using the cache.
+"""
+from __future__ import print_function
+from builtins import range
+from builtins import object
+import time
+
+import opscore.protocols.keys as keys
+import opscore.protocols.types as types
+
+import archiver.protocol
+import archiver.database
+from ingestBenchmark import Options
+
+repeat = 100000
+
+class BenchActor(object):
+    name = 'bench'
+
+options = Options()
+archiver.protocol.MessageReceiver.options = options
+archiver.database.init(options)
+archiver.database.initCoreTables(100,100)
+
+kdict = keys.KeysDictionary('bench',(1,0),
+    keys.Key('pos',types.Float(name='pos')*8,types.Int(name='status')*4))
+key = kdict['pos']
+actor = BenchActor()
+archiver.database.KeyTable.attach(actor,key)
+
+begin = time.time()
+for count in range(repeat):
+    del key.keyTable
+    archiver.database.KeyTable.attach(actor,key)
+elapsed = time.time() - begin
+print('full attach:   %.3f secs: rate = %.2f kHz' % (elapsed,1e-3*repeat/elapsed))
+
+begin = time.time()
+for count in range(repeat):
+    archiver.database.KeyTable.attach(actor,key)
+elapsed = time.time() - begin
+print('cached attach: %.3f secs: rate = %.2f kHz' % (elapsed,1e-3*repeat/elapsed))
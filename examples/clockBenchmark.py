@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+"""
+Compares the cost of timestamping a reply in TAI MJD seconds
+
+The astrotime timestamp is what ReplyReceiver used to compute for every reply.
+The TAIClock timestamp is what it now computes using float arithmetic.
+"""
+from __future__ import print_function
+from builtins import range
+import time
+
+from opscore.utility import astrotime
+
+from archiver.clock import TAIClock
+
+repeat = 100000
+
+begin = time.time()
+for count in range(repeat):
+    tai = astrotime.AstroTime.now(tz=astrotime.TAI).MJD()*86400.
+elapsed = time.time() - begin
+print('astrotime: %.3f secs: rate = %.2f kHz' % (elapsed,1e-3*repeat/elapsed))
+
+clock = TAIClock()
+begin = time.time()
+for count in range(repeat):
+    tai = clock()
+elapsed = time.time() - begin
+print('TAIClock:  %.3f secs: rate = %.2f kHz' % (elapsed,1e-3*repeat/elapsed))
+
+print('difference: %.6f secs' % (clock() - astrotime.AstroTime.now(tz=astrotime.TAI).MJD()*86400.))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Compares the per-row cost of formatting key table rows for the database
+
+The legacy encoder below reproduces the type dispatch that Table.record used to
+perform for every column of every row. The precompiled encoder is the one that
+each Table now builds once from its column types.
+"""
+from __future__ import print_function
+from builtins import range
+import time
+import opscore.protocols.types as types
+from archiver.database import Table,rowEncoder
+
+repeat = 20000
+
+def legacyEncode(columnFinalTypes,rowValues):
+    rowString = ''
+    for index in range(len(columnFinalTypes)):
+        storage = columnFinalTypes[index].storage.lower()
+        try:
+            value = rowValues[index]
+        except IndexError:
+            value = types.InvalidValue
+        if index:
+            rowString += ','
+        if value is types.InvalidValue:
+            pass
+        elif hasattr(value,'storageValue'):
+            rowString += value.storageValue()
+        elif storage == 'text':
+            rowString += "'%s'" % value.replace("'","''")
+        elif storage[:3] == 'int':
+            if isinstance(type(value),types.UInt) and (value & 0x80000000):
+                encoded = -(int(value)&0x7fffffff)
+                rowString += str(encoded)
+            else:
+                rowString += str(int(value))
+        elif storage[:3] == 'flt':
+            rowString += repr(float(value))
+    return rowString + '\n'
+
+# a wide keyword with repeated float and int values, prepended by a raw_id column
+columnTypes = (
+    types.Long(name='raw_id'),
+    types.Float(name='pos')*32,
+    types.Int(name='status')*16,
+    types.String(name='label'),
+)
+aliases,colNames,valueTypes = Table.prepareColumnNames(columnTypes)
+print('Encoding %d rows of %d columns' % (repeat,len(colNames)))
+
+rows = [ ]
+for count in range(repeat):
+    row = [ valueTypes[0](count) ]
+    for vtype in valueTypes[1:33]:
+        row.append(vtype(count*1.2345))
+    for vtype in valueTypes[33:49]:
+        row.append(vtype(count % 7))
+    row.append(valueTypes[49]("it's %d" % count))
+    rows.append(tuple(row))
+
+begin = time.time()
+legacy = [ legacyEncode(valueTypes,row) for row in rows ]
+elapsed = time.time() - begin
+print('legacy encoder:      %.3f secs: rate = %.2f kHz' % (elapsed,1e-3*repeat/elapsed))
+
+encode = rowEncoder(valueTypes)
+begin = time.time()
+precompiled = [ encode(row) for row in rows ]
+elapsed = time.time() - begin
+print('precompiled encoder: %.3f secs: rate = %.2f kHz' % (elapsed,1e-3*repeat/elapsed))
+
+assert precompiled == legacy
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Measures reply ingest throughput with and without worker threads
+
+Usage: ingestBenchmark.py [NTHREADS]
+
+Feeds the hub simulator's fake replies through a ReplyReceiver without any
+database engine, either on the reactor thread (NTHREADS=0, the default) or
+using a pool of NTHREADS worker threads, and reports the rate at which reply
+headers are recorded. Run from this directory with ics_actorkeys set up so
+that the actor dictionaries can be loaded.
+
+Parsing and validation are pure python and hold the interpreter lock, so worker
+threads mainly keep the reactor responsive and do not necessarily raise the
+recorded rate. Compare both modes on the target host before enabling them.
+"""
+from __future__ import print_function
+from builtins import range
+from builtins import object
+import sys
+import time
+import tempfile
+
+from twisted.internet import reactor
+
+import archiver.protocol
+import archiver.database
+from hubSimulator import fakeData
+
+repeat = 2000
+
+class Options(object):
+    tmpPath = tempfile.mkdtemp(prefix='ingestBenchmark')
+    dbEngine = 'none'
+    dbHost,dbUser,dbPassword,dbName = '','','',''
+    copyFormat = 'csv'
+    bufferMode = 'memory'
+    keyBufferSize = 100
+    groupCommit = 0
+    maxFlushes = 1
+    bufferLimit = 100000
+    maxQueued = 100
+    flushLatency = 0
+    minBufferSize = 1
+    maxBufferSize = 1000
+    pingInterval = 0
+    maxAge = None
+    systemClock = 'UTC'
+    keywordCache = 10000
+    storePolicy = ''
+    rollups = ''
+    queryCache = 0
+    cacheChunk = 3600
+    columnarDecode = False
+    traceList = ''
+
+def main(nThreads):
+    options = Options()
+    archiver.protocol.MessageReceiver.options = options
+    archiver.database.init(options)
+    archiver.database.initCoreTables(100,100)
+    messages = [ line.strip() for line in fakeData.split('\n') ]*repeat
+    receiver = archiver.protocol.ReplyReceiver()
+    # attach each actor before timing so that dictionary loading is not included
+    for message in messages[:len(messages)//repeat]:
+        receiver.messageReceived(message)
+    expected = receiver.replyHdr.nRows + len(messages)
+    if nThreads:
+        archiver.protocol.ReplyReceiver.startWorkers(nThreads)
+    def run():
+        begin = time.time()
+        for message in messages:
+            receiver.messageReceived(message)
+        fed = time.time() - begin
+        def check():
+            if receiver.replyHdr.nRows < expected:
+                reactor.callLater(0.001,check)
+                return
+            elapsed = time.time() - begin
+            print('%d threads: fed %d replies in %.3f secs, recorded in %.3f secs: rate = %.2f kHz'
+                % (nThreads,len(messages),fed,elapsed,1e-3*len(messages)/elapsed))
+            reactor.stop()
+        check()
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
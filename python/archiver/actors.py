@@ -23,6 +23,9 @@ class Actor(object):
     # the SQL table name containing known actors (should be lowercase)
     tableName = 'actors'
     table = None
+
+    # set when another process owns the actors table and assigns actor IDs
+    readOnly = False
     
     @staticmethod
     def attach(name,dictionaryRequired=False):
@@ -38,7 +41,7 @@ class Actor(object):
     def __init__(self,name,dictionaryRequired):
         self.name = name
         # first time initialization of database table
-        if not Actor.table:
+        if not Actor.table and not Actor.readOnly:
             Actor.table = database.Table.attach(Actor.tableName,(
                 types.UInt(name='id'),
                 types.String(name='name'),
@@ -61,7 +64,10 @@ class Actor(object):
             (major,minor) = (0,0)
             
         # is this actor already in the database?
-        if name in Actor.existing:
+        if Actor.readOnly:
+            # our idnum will be assigned by the process that owns the actors table
+            self.idnum = None
+        elif name in Actor.existing:
             (ex_idnum,ex_major,ex_minor,ex_cksum) = Actor.existing[name]
             if (major,minor) == (ex_major,ex_minor):
                 if cksum != ex_cksum:
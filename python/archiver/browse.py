@@ -10,8 +10,11 @@ from __future__ import print_function
 from builtins import zip
 from builtins import str
 import datetime
+import json
 
-from archiver import actors,web,database
+from twisted.python import log
+
+from archiver import actors,web,database,decimate,columns
 from opscore.utility import html
 from opscore.protocols import types
 
@@ -33,11 +36,75 @@ def appendToHTMLTable(tableData,table):
         table.append(row)
     return table
 
+def appendPageToHTMLTable(page,table):
+    """
+    Returns the input HTML table with a page of rows and any next page token appended
+
+    The token is the id of a final 'next-page' row, after a 'page-' prefix.
+    """
+    rows,token = page
+    appendToHTMLTable(rows,table)
+    if token:
+        table.append(html.Tr(html.Td('More rows are available'),
+            className='next-page',id='page-%s' % token))
+    return table
+
+def csvValue(value):
+    """
+    Returns one value of a key table row formatted for CSV
+    """
+    if isinstance(value,datetime.datetime):
+        # use ISO format but drop the time zone offset
+        return value.isoformat()[:-6]
+    elif value is types.InvalidValue:
+        return ''
+    value = str(value)
+    if ',' in value or '"' in value or '\n' in value:
+        value = '"%s"' % value.replace('"','""')
+    return value
+
+def csvBatch(batch):
+    """
+    Returns the rows of a columns.ColumnBatch formatted as CSV lines
+
+    Columns whose values print the same as their stored values are formatted
+    straight from the batch, so typed values are only built for the others.
+    """
+    fields = [ [ csvValue(timestamp) for timestamp in batch.timestamps() ] ]
+    for col,plain in enumerate(batch.layout.plain):
+        if plain:
+            fields.append([ '' if value is None else csvValue(value)
+                for value in batch.values(col) ])
+        else:
+            fields.append([ csvValue(value) for value in batch.typedValues(col) ])
+    return ''.join(','.join(row) + '\n' for row in zip(*fields))
+
+def plotJSON(reducer,keytag,alias,mode,nPoints):
+    """
+    Returns the points kept by a reducer as compact JSON for plotting
+
+    Timestamps are returned as milliseconds since the unix epoch, as used by flot.
+    """
+    points = reducer.points()
+    if mode == 'lttb':
+        points = decimate.lttb(points,nPoints)
+    epoch = 40587*86400.
+    return json.dumps({
+        'key': keytag,
+        'column': alias,
+        'rows': reducer.nPoints,
+        'x': [ int(round(1000*(x - epoch))) for x,y in points ],
+        'y': [ y for x,y in points ]
+    },separators=(',',':'))
+
 class BrowseHandler(web.WebQuery):
     
     title = 'SDSS3 Archiver Browser'
     
     ivalMultipliers = { 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800 }
+
+    # plots are decimated to at most this many points
+    maxPlotPoints = 10000
     
     def __init__(self,serviceName,options):
         self.options = options
@@ -141,12 +208,138 @@ class BrowseHandler(web.WebQuery):
     def error(self,msg):
         return html.Div(msg,className='error')
 
+    def plot(self,request,keyTable,nPoints,interval,endAt):
+        """
+        Returns one column of a key table within a date range decimated for plotting
+
+        The optional 'col' parameter names the column (default is the first) and
+        'mode' selects lttb (the default) or minmax decimation.
+        """
+        try:
+            nPoints = int(nPoints)
+        except ValueError:
+            return self.error("Invalid value for parameter 'plot'")
+        if not 3 <= nPoints <= self.maxPlotPoints:
+            return self.error("Parameter 'plot' must be 3-%d" % self.maxPlotPoints)
+        if not (interval and endAt):
+            return self.error("Parameters 'ival' and 'end' are required to plot")
+        aliases = keyTable.aliases[1:]
+        alias = request.args.get('col',aliases[:1] or [None])[-1]
+        if alias not in aliases:
+            return self.error('Unknown column %s of %s' % (alias,keyTable.tag))
+        mode = request.args.get('mode',['lttb'])[-1]
+        if mode not in ('lttb','minmax'):
+            return self.error("Invalid value for parameter 'mode'")
+        begin,end = database.KeyTable.dateRange(interval,endAt)
+        # min/max keeps two points per bucket and LTTB selects from twice as many buckets
+        nBuckets = max(1,nPoints//2) if mode == 'minmax' else 2*nPoints
+        reducer = decimate.BucketReducer(begin,end,nBuckets)
+        try:
+            result = keyTable.reduceByDate(aliases.index(alias),begin,end,reducer)
+        except database.DatabaseException as e:
+            return self.error(str(e))
+        request.setHeader('content-type','application/json')
+        return result.addCallback(plotJSON,keyTable.tag,alias,mode,nPoints).addErrback(
+            self.plotFailed,request,keyTable.tag)
+
+    def plotFailed(self,failure,request,keytag):
+        """
+        Reports a plot query that failed instead of plotting partial data
+        """
+        log.err(failure,'Unable to plot %s' % keytag)
+        request.setHeader('content-type','text/html')
+        return self.error('Unable to plot %s: %s' % (keytag,failure.getErrorMessage()))
+
+    def parseRange(self,interval,endAt):
+        """
+        Returns the 'ival' parameter in seconds and the parsed 'end' parameter
+
+        Raises ValueError for an invalid value. Missing values are returned unchanged.
+        """
+        if interval:
+            unit = interval[-1]
+            duration = None
+            try:
+                duration = int(interval[:-1])
+            except ValueError:
+                pass
+            if unit not in self.ivalMultipliers or not duration:
+                raise ValueError("Invalid value for parameter 'ival'")
+            interval = duration*self.ivalMultipliers[unit]
+        if endAt:
+            if endAt != 'now':
+                try:
+                    endAt = int(endAt)
+                except ValueError:
+                    raise ValueError("Invalid value for parameter 'end'")
+        return interval,endAt
+
+    def exportMerged(self,request,keyList,interval,endAt):
+        """
+        Streams the rows of several keywords within a date range as CSV in TAI order
+
+        The keywords are a comma-separated list of actor.keyword names. Each CSV
+        line has a timestamp, the keyword's actor.keyword name and its values.
+        """
+        try:
+            interval,endAt = self.parseRange(interval,endAt)
+        except ValueError as e:
+            return self.error(str(e))
+        if not interval or not endAt:
+            return self.error("Parameters 'ival' and 'end' are required to export")
+        keyTables = [ ]
+        for keytag in keyList.split(','):
+            actorName,dot,keyName = keytag.strip().lower().partition('.')
+            if not database.KeyTable.exists(actorName,keyName):
+                return self.error('No data recorded for %s' % keytag)
+            try:
+                actor = actors.Actor.attach(actorName,dictionaryRequired=True)
+                keyTables.append(database.KeyTable.attach(actor,actor.kdict[keyName]))
+            except Exception as e:
+                return self.error('Unable to read %s: %s' % (keytag,e.__class__.__name__))
+        request.setHeader('content-type','text/csv')
+        request.setHeader('content-disposition','attachment; filename="merged.csv"')
+        request.write('tai,key,values\n')
+        def writeRows(rows):
+            request.write(''.join(
+                ','.join([ csvValue(row[0]),keytag ] + [ csvValue(value) for value in row[1:] ])
+                + '\n' for keytag,row in rows))
+        return database.KeyTable.mergeByDate(keyTables,interval,endAt,writeRows).addCallback(
+            lambda nRows: '')
+
+    def export(self,request,keyTable,interval,endAt):
+        """
+        Streams all rows of a key table within a date range as CSV
+
+        Rows are written to the client as each batch is fetched, so exports are
+        not limited to the 1000 rows displayed in a table.
+        """
+        if not interval or not endAt:
+            return self.error("Parameters 'ival' and 'end' are required to export")
+        request.setHeader('content-type','text/csv')
+        request.setHeader('content-disposition',
+            'attachment; filename="%s.csv"' % keyTable.tag)
+        request.write(','.join(['tai'] + keyTable.aliases[1:]) + '\n')
+        def writeRows(rows):
+            if isinstance(rows,columns.ColumnBatch):
+                request.write(csvBatch(rows))
+                return
+            request.write(''.join(
+                ','.join(csvValue(value) for value in row) + '\n' for row in rows))
+        return keyTable.streamByDate(interval,endAt,writeRows).addCallback(lambda nRows: '')
+
     def POST(self,request,session,state):
         actorName = request.args.get('actor',[None])[-1]
         keyName = request.args.get('key',[None])[-1]
         nRecent = request.args.get('recent',[None])[-1]
         interval = request.args.get('ival',[None])[-1]
         endAt = request.args.get('end',[None])[-1]
+        nPlot = request.args.get('plot',[None])[-1]
+        pageToken = request.args.get('page',[None])[-1]
+        keyList = request.args.get('keys',[None])[-1]
+        if keyList:
+            # export several keywords merged into one stream
+            return self.exportMerged(request,keyList,interval,endAt)
         if actorName:
             if (actorName not in actors.Actor.existing and
                 actorName not in actors.Actor.registry):
@@ -181,22 +374,16 @@ class BrowseHandler(web.WebQuery):
                                 nRecent = int(nRecent)
                             except ValueError:
                                 return self.error("Invalid value for parameter 'recent'")
-                        if interval:
-                            unit = interval[-1]
-                            duration = None
-                            try:
-                                duration = int(interval[:-1])
-                            except ValueError:
-                                pass
-                            if unit not in self.ivalMultipliers or not duration:
-                                return self.error("Invalid value for parameter 'ival'")
-                            interval = duration*self.ivalMultipliers[unit]
-                        if endAt:
-                            if endAt != 'now':
-                                try:
-                                    endAt = int(endAt)
-                                except ValueError:
-                                    return self.error("Invalid value for parameter 'end'")
+                        try:
+                            interval,endAt = self.parseRange(interval,endAt)
+                        except ValueError as e:
+                            return self.error(str(e))
+                        # is this a request for plot data?
+                        if nPlot:
+                            return self.plot(request,keyTable,nPlot,interval,endAt)
+                        # is this a request to export rows as CSV?
+                        if 'csv' in request.args:
+                            return self.export(request,keyTable,interval,endAt)
                         # if we get this far we have a valid query so prepare a table
                         table = html.Table()
                         # The first header row lists the column names and the first
@@ -212,7 +399,19 @@ class BrowseHandler(web.WebQuery):
                         for vType in keyTable.columnFinalTypes[1:]:
                             hdr.append(html.Th(vType.units or ''))
                         table.append(hdr)
-                        if nRecent:
+                        if pageToken:
+                            # display a page of rows, continuing a previous page unless
+                            # this is the first page of the specified period
+                            if pageToken == 'first':
+                                if not interval or not endAt:
+                                    return self.error("Parameters 'ival' and 'end' are required")
+                                pageToken = None
+                            try:
+                                result = keyTable.page(interval,endAt,pageToken)
+                            except database.DatabaseException as e:
+                                return self.error(str(e))
+                            return result.addCallback(appendPageToHTMLTable,table)
+                        elif nRecent:
                             # display the most recent rows recorded
                             return keyTable.recent(nRecent).addCallback(
                                 appendToHTMLTable,table)
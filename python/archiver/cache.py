@@ -0,0 +1,68 @@
+"""
+An LRU cache of immutable query results within a byte budget
+"""
+
+import sys
+import collections
+
+class QueryCache(object):
+    """
+    Caches the rows of settled key table chunks, evicting the least recently used
+
+    Key tables split their settled history into chunks of chunkSeconds of TAI
+    time, aligned to multiples of chunkSeconds, that can no longer change so
+    never need to be invalidated. The cache holds at most budget bytes, as
+    estimated by rowBytes, and a budget of zero disables it.
+    """
+    # the maximum number of adjacent missing chunks to fetch in one query
+    maxFetch = 24
+
+    def __init__(self,budget,chunkSeconds):
+        self.budget = budget
+        self.chunkSeconds = chunkSeconds
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self,key):
+        return key in self.entries
+
+    def get(self,key):
+        """
+        Returns the cached value for key or None
+        """
+        try:
+            value,nBytes = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self,key,value,nBytes):
+        """
+        Caches a value that uses about nBytes, evicting older values to make room
+        """
+        # do not let one value flush most of the cache
+        if nBytes > self.budget//4:
+            return
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (value,nBytes)
+        self.bytes += nBytes
+        while self.bytes > self.budget:
+            evicted,(value,nBytes) = self.entries.popitem(last=False)
+            self.bytes -= nBytes
+            self.evictions += 1
+
+def rowBytes(row):
+    """
+    Returns an estimate of the memory used by a row of values
+    """
+    return sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
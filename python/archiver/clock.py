@@ -0,0 +1,41 @@
+"""
+Fast TAI timestamps for the ingest path
+"""
+
+import time
+
+from opscore.utility import astrotime
+
+class TAIClock(object):
+    """
+    Returns the current TAI time in MJD seconds using float arithmetic
+
+    The offset between the system clock and TAI MJD seconds (the MJD epoch plus
+    any leap seconds) is calibrated against astrotime when the clock is created
+    and then every recalibrate seconds, so that a new leap second is picked up.
+    Use systemClock='TAI' when the system clock is already tracking TAI.
+    """
+    def __init__(self,systemClock='UTC',recalibrate=3600.):
+        # use UTC for timestamps when the system clock is actually tracking TAI
+        if systemClock == 'TAI':
+            self.timestampTZ = astrotime.UTC
+        else:
+            self.timestampTZ = astrotime.TAI
+        self.recalibrate = recalibrate
+        self.calibrate()
+
+    def calibrate(self):
+        """
+        Calibrates our offset from the system clock using astrotime
+        """
+        now = time.time()
+        mjdSecs = astrotime.AstroTime.now(tz=self.timestampTZ).MJD()*86400.
+        # the offset is a whole number of seconds so rounding removes calibration jitter
+        self.offset = float(round(mjdSecs - now))
+        self.calibrateAt = now + self.recalibrate
+
+    def __call__(self):
+        now = time.time()
+        if now >= self.calibrateAt:
+            self.calibrate()
+        return now + self.offset
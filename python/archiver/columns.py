@@ -0,0 +1,310 @@
+"""
+Columnar in-memory storage for buffered key table rows
+"""
+
+import bisect
+import datetime
+from array import array
+
+from opscore.protocols import types
+from opscore.utility import astrotime
+
+try:
+    import numpy
+except ImportError:
+    # columnar decoding of query results is not available
+    numpy = None
+
+"""
+The array typecodes used to store each numeric storage type. Text columns are
+stored as utf-8 bytes with an array of end offsets.
+"""
+typecodes = {
+    'int2': 'h',
+    'int4': 'i',
+    'int8': 'q',
+    'flt4': 'f',
+    'flt8': 'd'
+}
+
+def taiTimestamp(seconds):
+    """
+    Returns an AstroTime for a TAI timestamp in MJD seconds
+    """
+    return astrotime.AstroTime.fromMJD(seconds,86400.)/astrotime.TAI
+
+def storageConverter(vtype):
+    """
+    Returns a function that converts a value to the python value stored in its column
+    """
+    storage = vtype.storage.lower()
+    if storage == 'text':
+        convert = str
+    elif storage[:3] == 'int':
+        # UInt values are stored using the MSB as a sign bit
+        convert = uintStorage if isinstance(vtype,types.UInt) else int
+    else:
+        convert = float
+    if hasattr(vtype,'storageValue'):
+        convert = storageValueConverter(convert,storage)
+    return convert
+
+def plainType(vtype):
+    """
+    Returns True if the values of a type print the same as their stored values
+    """
+    return (isinstance(vtype,(types.Int,types.Long,types.Float,types.Double,types.String))
+        and not isinstance(vtype,types.UInt) and not hasattr(vtype,'storageValue')
+        and getattr(vtype,'strFmt',None) is None)
+
+def uintStorage(value):
+    value = int(value)
+    if value & 0x80000000:
+        # interpret the MSB as a sign bit to encode a UInt as as an Int
+        value = -(value&0x7fffffff)
+    return value
+
+def storageValueConverter(convert,storage):
+    """
+    Wraps a storage converter to use a value's own storageValue() when it has one
+    """
+    def storageValue(value):
+        try:
+            value = value.storageValue()
+        except AttributeError:
+            return convert(value)
+        # storage values are formatted for CSV so strip any text quoting
+        if storage == 'text' and value[:1] == "'":
+            value = value[1:-1].replace("''","'")
+        return convert(value)
+    return storageValue
+
+class ColumnLayout(object):
+    """
+    Describes how the value columns of a key table are stored in a ColumnBuffer
+    """
+    def __init__(self,valueTypes):
+        self.vtypes = list(valueTypes)
+        self.converters = [ storageConverter(vtype) for vtype in self.vtypes ]
+        self.typecodes = [ typecodes.get(vtype.storage.lower()) for vtype in self.vtypes ]
+        self.plain = [ plainType(vtype) for vtype in self.vtypes ]
+
+class ColumnBuffer(object):
+    """
+    Stores buffered key table rows in one typed array per column
+
+    Each row is timestamped in TAI MJD seconds and identified by its raw ID.
+    A timestamp earlier than the previous row's, after the system clock steps
+    back, is clamped to the previous timestamp so that the timestamps can be
+    searched by bisection.
+    Values are stored as they are in the database, so a row costs a few bytes
+    per value rather than one python object per value. Invalid or missing
+    values are flagged in a per-column bytearray that is only created once the
+    column has its first invalid value.
+    """
+    def __init__(self,layout):
+        self.layout = layout
+        self.tai = array('d')
+        self.rawID = array('q')
+        # numeric values, or the end offset of each value within its text bytes
+        self.columns = [ array(code or 'q') for code in layout.typecodes ]
+        self.text = [ None if code else bytearray() for code in layout.typecodes ]
+        self.nulls = [ None ]*len(layout.typecodes)
+
+    def __len__(self):
+        return len(self.rawID)
+
+    def append(self,tai,rawID,values):
+        """
+        Appends one row of typed values
+        """
+        index = len(self.rawID)
+        invalid = types.InvalidValue
+        try:
+            for col,convert in enumerate(self.layout.converters):
+                # We might have fewer values than columns if the last columnType is
+                # repeated with variable length.
+                value = values[col] if col < len(values) else invalid
+                column,text,nulls = self.columns[col],self.text[col],self.nulls[col]
+                if value is invalid:
+                    if nulls is None:
+                        nulls = self.nulls[col] = bytearray(index)
+                    nulls.append(1)
+                    column.append(0 if text is None else len(text))
+                    continue
+                value = convert(value)
+                if text is None:
+                    column.append(value)
+                else:
+                    text.extend(value.encode('utf-8'))
+                    column.append(len(text))
+                if nulls is not None:
+                    nulls.append(0)
+        except Exception:
+            self.truncate(index)
+            raise
+        # keep timestamps monotonic so that they can be searched by bisection
+        if index and tai < self.tai[-1]:
+            tai = self.tai[-1]
+        self.tai.append(tai)
+        self.rawID.append(rawID)
+
+    def between(self,begin,end):
+        """
+        Returns the range of row indices timestamped from begin to end inclusive
+        """
+        return bisect.bisect_left(self.tai,begin),bisect.bisect_right(self.tai,end)
+
+    def truncate(self,length):
+        """
+        Discards any values stored beyond the first length rows
+        """
+        del self.tai[length:]
+        del self.rawID[length:]
+        for column,text,nulls in zip(self.columns,self.text,self.nulls):
+            del column[length:]
+            if text is not None:
+                del text[column[-1] if length else 0:]
+            if nulls is not None:
+                del nulls[length:]
+
+    def row(self,index):
+        """
+        Returns the row at index as a list of its timestamp and typed values
+        """
+        row = [ taiTimestamp(self.tai[index]) ]
+        for col,vtype in enumerate(self.layout.vtypes):
+            nulls = self.nulls[col]
+            if nulls is not None and nulls[index]:
+                row.append(types.InvalidValue)
+                continue
+            column,text = self.columns[col],self.text[col]
+            if text is None:
+                value = column[index]
+            else:
+                begin = column[index-1] if index else 0
+                value = text[begin:column[index]].decode('utf-8')
+            row.append(vtype(value))
+        return row
+
+class ColumnBatch(object):
+    """
+    Holds a batch of key table rows as one numpy array per column
+
+    Timestamps are float64 TAI MJD seconds and numeric values are stored as
+    they are in the database, with NaN for a missing float value and a masked
+    entry for a missing integer value. Text values are kept in lists with None
+    for a missing value. The typed rows returned by keyTableFetch are only
+    created when the batch is iterated or a row is requested, and consumers
+    that only format values can read each column's stored values instead.
+    """
+    def __init__(self,layout,tai,columns,masks):
+        self.layout = layout
+        self.tai = tai
+        self.columns = columns
+        self.masks = masks
+
+    def __len__(self):
+        return len(self.tai)
+
+    def __iter__(self):
+        for index in range(len(self.tai)):
+            yield self.row(index)
+
+    def timestamps(self):
+        """
+        Returns the timestamp of each row, only converting the first with taiTimestamp
+        """
+        if not len(self.tai):
+            return [ ]
+        first = float(self.tai[0])
+        origin = taiTimestamp(first)
+        return [ origin + datetime.timedelta(seconds=tai - first) for tai in self.tai.tolist() ]
+
+    def values(self,col):
+        """
+        Returns one column as a list of its stored values with None for a missing value
+        """
+        column,mask = self.columns[col],self.masks[col]
+        if self.layout.typecodes[col] is None:
+            return column
+        values = column.data.tolist() if numpy.ma.isMaskedArray(column) else column.tolist()
+        if not mask.any():
+            return values
+        return [ None if missing else value for value,missing in zip(values,mask.tolist()) ]
+
+    def typedValues(self,col):
+        """
+        Returns one column as a list of typed values with InvalidValue for a missing value
+        """
+        vtype,invalid = self.layout.vtypes[col],types.InvalidValue
+        return [ invalid if value is None else vtype(value) for value in self.values(col) ]
+
+    def row(self,index):
+        """
+        Returns the row at index as a list of its timestamp and typed values
+        """
+        row = [ taiTimestamp(float(self.tai[index])) ]
+        for vtype,code,column,mask in zip(
+            self.layout.vtypes,self.layout.typecodes,self.columns,self.masks):
+            if mask[index]:
+                row.append(types.InvalidValue)
+            elif code is None:
+                row.append(vtype(column[index]))
+            elif code in 'fd':
+                row.append(vtype(float(column[index])))
+            else:
+                row.append(vtype(int(column.data[index])))
+        return row
+
+def fetchedBatch(layout,rows):
+    """
+    Returns a ColumnBatch of rows fetched from the database
+
+    Each row is a TAI timestamp in MJD seconds followed by its stored values.
+    """
+    transposed = list(zip(*rows)) or [ () ]*(1 + len(layout.vtypes))
+    tai = numpy.array(transposed[0],dtype=numpy.float64)
+    columns,masks = [ ],[ ]
+    for code,values in zip(layout.typecodes,transposed[1:]):
+        mask = numpy.array([ value is None for value in values ],dtype=bool)
+        if code is None:
+            column = list(values)
+        elif code in 'fd':
+            column = numpy.array(values,dtype=numpy.float64)
+        else:
+            column = numpy.ma.masked_array(numpy.array(
+                [ 0 if value is None else value for value in values ],dtype=numpy.int64),
+                mask=mask)
+        columns.append(column)
+        masks.append(mask)
+    return ColumnBatch(layout,tai,columns,masks)
+
+def bufferedBatch(buffer,begin,end):
+    """
+    Returns a ColumnBatch of the rows from begin to end of a ColumnBuffer
+    """
+    layout = buffer.layout
+    tai = numpy.array(buffer.tai[begin:end],dtype=numpy.float64)
+    columns,masks = [ ],[ ]
+    for code,column,text,nulls in zip(
+        layout.typecodes,buffer.columns,buffer.text,buffer.nulls):
+        if nulls is None:
+            mask = numpy.zeros(end - begin,dtype=bool)
+        else:
+            mask = numpy.frombuffer(bytes(nulls[begin:end]),dtype=numpy.uint8) != 0
+        if text is not None:
+            values = [ ]
+            for index in range(begin,end):
+                first = column[index-1] if index else 0
+                values.append(None if nulls is not None and nulls[index] else
+                    text[first:column[index]].decode('utf-8'))
+        elif code in 'fd':
+            values = numpy.array(column[begin:end],dtype=numpy.float64)
+            values[mask] = numpy.nan
+        else:
+            values = numpy.ma.masked_array(
+                numpy.array(column[begin:end],dtype=numpy.int64),mask=mask)
+        columns.append(values)
+        masks.append(mask)
+    return ColumnBatch(layout,tai,columns,masks)
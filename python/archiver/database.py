@@ -3,14 +3,14 @@ Archiver interface to database storage
 """
 # Created 01-Mar-2009 by David Kirkby (dkirkby@uci.edu)
 
-import os,os.path,string,time
+import os,os.path,io,re,string,time,struct,heapq,itertools,collections,bisect,base64,binascii
 
-from twisted.internet import defer
+from twisted.internet import defer,threads
 from twisted.python import log
 
 from opscore.protocols import types,messages
 from opscore.utility import astrotime
-from . import actors
+from . import actors,columns,clock,policy,cache
 
 class DatabaseException(Exception):
     pass
@@ -29,6 +29,120 @@ sqlTypes = {
     'text': 'text'
 }
 
+"""
+The struct formats used to encode each storage type in the PostgreSQL binary
+COPY format, together with the fixed header and trailer of a binary COPY stream.
+"""
+binaryFormats = {
+    'int2': 'h',
+    'int4': 'i',
+    'int8': 'q',
+    'flt4': 'f',
+    'flt8': 'd'
+}
+binaryHeader = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii',0,0)
+binaryTrailer = struct.pack('!h',-1)
+
+def rowEncoder(valueTypes,binary=False):
+    """
+    Returns a function that encodes a tuple of row values for the database
+
+    Rows are encoded as one line of CSV text unless binary is set, in which case
+    they are encoded as one tuple of a PostgreSQL binary COPY stream. The
+    formatting of each column is decided here, once, from its storage type so
+    that encoding a row does not need to inspect any types.
+    """
+    if binary:
+        return binaryRowEncoder(valueTypes)
+    invalid = types.InvalidValue
+    encoders = [ ]
+    for vtype in valueTypes:
+        storage = vtype.storage.lower()
+        if storage == 'text':
+            encoder = encodeText
+        elif storage[:3] == 'int':
+            # UInt values are stored using the MSB as a sign bit
+            encoder = encodeUInt if isinstance(vtype,types.UInt) else encodeInt
+        elif storage[:3] == 'flt':
+            encoder = encodeFloat
+        else:
+            raise DatabaseException('database: unsupported storage type: %s' % storage)
+        if hasattr(vtype,'storageValue'):
+            encoder = storageValueEncoder(encoder)
+        encoders.append(encoder)
+    nColumns = len(encoders)
+    def encode(rowValues):
+        # an invalid value leaves its field empty to signal a NULL SQL value
+        fields = [ '' if value is invalid else encoder(value)
+            for encoder,value in zip(encoders,rowValues) ]
+        # We might have fewer values than columns if the last columnType is
+        # repeated with variable length.
+        return ','.join(fields) + ','*(nColumns-len(fields)) + '\n'
+    return encode
+
+def encodeText(value):
+    return "'%s'" % value.replace("'","''")
+
+def encodeInt(value):
+    return str(int(value))
+
+def encodeUInt(value):
+    if value & 0x80000000:
+        # interpret the MSB as a sign bit to encode a UInt as as an Int
+        return str(-(int(value)&0x7fffffff))
+    return str(int(value))
+
+def encodeFloat(value):
+    return repr(float(value))
+
+def storageValueEncoder(encoder):
+    """
+    Wraps a column encoder to use a value's own storageValue() when it has one
+    """
+    def encode(value):
+        try:
+            return value.storageValue()
+        except AttributeError:
+            return encoder(value)
+    return encode
+
+def binaryRowEncoder(valueTypes):
+    """
+    Returns a function that encodes a tuple of row values as one binary COPY tuple
+    """
+    invalid = types.InvalidValue
+    null = struct.pack('!i',-1)
+    encoders = [ ]
+    for vtype in valueTypes:
+        storage = vtype.storage.lower()
+        if storage != 'text' and storage not in binaryFormats:
+            raise DatabaseException('database: unsupported storage type: %s' % storage)
+        encoders.append(binaryPacker(storage,columns.storageConverter(vtype)))
+    nColumns = len(encoders)
+    fieldCount = struct.pack('!h',nColumns)
+    def encode(rowValues):
+        fields = [ null if value is invalid else encoder(value)
+            for encoder,value in zip(encoders,rowValues) ]
+        # We might have fewer values than columns if the last columnType is
+        # repeated with variable length.
+        return fieldCount + b''.join(fields) + null*(nColumns-len(fields))
+    return encode
+
+def binaryPacker(storage,convert):
+    """
+    Returns a function that packs a value as a length-prefixed binary field
+    """
+    if storage == 'text':
+        def pack(value):
+            encoded = convert(value).encode('utf-8')
+            return struct.pack('!i',len(encoded)) + encoded
+    else:
+        fmt = struct.Struct('!i' + binaryFormats[storage])
+        size = fmt.size - 4
+        def pack(value):
+            return fmt.pack(size,convert(value))
+    return pack
+
 def init(options):
     """
     Initializes the specified database product.
@@ -36,6 +150,18 @@ def init(options):
     # create the buffer file path
     Table.bufferPath = options.tmpPath
     
+    # remember how rows are formatted and buffered for the database
+    Table.copyFormat = options.copyFormat
+    Table.bufferMode = options.bufferMode
+    
+    # postgres streams large query results through a server-side cursor
+    Table.serverCursors = (options.dbEngine == 'postgres')
+    
+    # stream query results as numpy columns instead of typed rows?
+    if options.columnarDecode and columns.numpy is None:
+        raise DatabaseException('Columnar decoding requires numpy')
+    KeyTable.columnar = options.columnarDecode
+    
     # check for a valid options.dbEngine and set engine-specific parameters
     global sqlTypes
     host,user,pw,db = options.dbHost,options.dbUser,options.dbPassword,options.dbName
@@ -51,6 +177,10 @@ def init(options):
         Table.insertStatement = string.Template(
             "LOAD DATA INFILE '$file' INTO TABLE $table FIELDS " +
             "TERMINATED BY ',' ENCLOSED BY ''''")
+        if options.copyFormat == 'binary':
+            raise DatabaseException('Binary copy format requires the postgres engine')
+        if options.bufferMode == 'memory':
+            raise DatabaseException('Memory buffer mode requires the postgres engine')
     elif options.dbEngine == 'none':
         print('will not use any database engine')
     else:
@@ -59,11 +189,44 @@ def init(options):
     # remember the KeyTable buffer size
     KeyTable.bufferSize = options.keyBufferSize
     
-    # use UTC for timestamps when the system clock is actually tracking TAI
-    if options.systemClock == 'TAI':
-        KeyTable.timestampTZ = astrotime.UTC
-    else:
-        KeyTable.timestampTZ = astrotime.TAI
+    # remember the group commit window
+    Table.groupWindow = options.groupCommit
+    
+    # remember how many buffers each table can load at once, and how many rows
+    # it can buffer in memory while waiting to load them
+    Table.maxInFlight = options.maxFlushes
+    Table.bufferLimit = options.bufferLimit
+    Table.maxQueued = options.maxQueued
+    
+    # remember the adaptive buffer sizing parameters
+    Table.latencyTarget = options.flushLatency
+    Table.minBufferSize = options.minBufferSize
+    Table.maxBufferSize = options.maxBufferSize
+    
+    # flush deadlines are only checked when the periodic ping task is running
+    if options.pingInterval > 0:
+        Table.maxAge = options.maxAge
+    
+    KeyTable.clock = clock.TAIClock(options.systemClock)
+    
+    # cache settled key table history in chunks (--query-cache MB, 0 to disable)
+    KeyTable.queryCache = cache.QueryCache(
+        int(options.queryCache*2**20),options.cacheChunk)
+    
+    # parse the rollup bucket widths (--rollups option)
+    Rollup.widths = [ ]
+    for label in options.rollups.lower().split(','):
+        label = label.strip()
+        if not label:
+            continue
+        # labels become part of a table name so only whole numbers of a unit are valid
+        if not re.match(r'[0-9]+[smhd]$',label):
+            raise DatabaseException('Invalid rollup bucket width: %s' % label)
+        width = float(label[:-1])*Rollup.units[label[-1]]
+        if width <= 0:
+            raise DatabaseException('Rollup bucket width must be positive: %s' % label)
+        Rollup.widths.append((width,label))
+    Rollup.widths.sort()
     
     # process the list of tables to trace activity on (--trace-list option)
     Table.traceList = [ ]
@@ -96,9 +259,15 @@ def init(options):
         tableName = tableInfo[0].lower()
         if tableName.startswith('sql_') or tableName.startswith('pg_'):
             continue
-        # lookup the number of rows already stored in this table
+        # get a list of this table's column names
+        cursor.execute("select * from %s where 1=0" % tableName)
+        columnNames = [ ]
+        for column in cursor.description:
+            columnNames.append(column[0].lower())
+        # lookup the number of rows already stored in this table using its
+        # first column, which is always its primary key (id or raw_id)
         #cursor.execute("select count(*) from %s" % tableName)
-        idLab = 'id' if tableName in ["reply_raw", "actors"] else 'raw_id'
+        idLab = columnNames[0]
         cursor.execute("select COALESCE(max(%s), 0) from %s" % (idLab, tableName))
         tableRows = cursor.fetchone()
         if tableRows is None:
@@ -106,11 +275,6 @@ def init(options):
         else:
             tableRows = tableRows[0]
         print("database: table %s contains %d rows" % (tableName,tableRows))
-        # get a list of this table's column names
-        cursor.execute("select * from %s where 1=0" % tableName)
-        columnNames = [ ]
-        for column in cursor.description:
-            columnNames.append(column[0].lower())
         Table.existing[tableName] = (tableRows,columnNames)
     
     # scan the table of known actors (if one is present)
@@ -138,6 +302,9 @@ def init(options):
     from twisted.internet import reactor
     reactor.addSystemEventTrigger('after','shutdown',shutdown,dbapi,**connectionArgs)
     
+    # Record any partially filled rollup buckets while we can still flush them normally.
+    reactor.addSystemEventTrigger('before','shutdown',Rollup.closeAll)
+    
     # Install a startup callback that initializes the core database tables.
     # We use a callback for this so that we can use the reactor and dbapi connection pool.
     reactor.addSystemEventTrigger('after','startup',initCoreTables,
@@ -166,23 +333,41 @@ def initCoreTables(rawBufferSize,hdrBufferSize):
     ),bufferSize=hdrBufferSize,indices=('actor_id',))
 
 
+def coreTablesReady():
+    """
+    Returns a Deferred that fires once the core tables exist in the database
+    """
+    return defer.DeferredList([ Table.registry[name].ready
+        for name in ('reply_raw','reply_hdr') if name in Table.registry ])
+
 def shutdown(dbapi,**connectionArgs):
     print('database: starting shutdown sequence')
     db = dbapi.connect(**connectionArgs)
     cursor = db.cursor()
-    tableFiles = []
+    # the buffers copied so far, which are only released once they are committed
+    loaded = [ ]
+    def load(bufferFile,table):
+        # use a savepoint so that one failed load does not abort the others
+        if copyBuffer(cursor,bufferFile,table,savepoint=True):
+            loaded.append(bufferFile)
+        else:
+            bufferFile.close()
+    # load any buffers still waiting for a group commit
+    for bufferFile,table,nRows in Table.group:
+        print('database: flushing %d grouped rows to %s' % (nRows,table.name))
+        load(bufferFile,table)
+    Table.group = [ ]
     # close out each table in turn
     for table in Table.registry.values():
+        # load any buffers still queued behind a flush in flight
+        for bufferFile,nRows in table.queued:
+            print('database: flushing %d queued rows to %s' % (nRows,table.name))
+            load(bufferFile,table)
+        table.queued.clear()
         if len(table.rowBuffer) > 1:
             print('database: flushing %d rows to %s' % (len(table.rowBuffer),table.name))
         if len(table.rowBuffer) > 0:
-            try:
-                bufferFileName = table.bufferFile.name
-                loadFile(cursor, table.bufferFile, table, doDelete=False)
-                tableFiles.append(bufferFileName)
-            except Exception as e:
-                log.err('shutdown on table %s failed with error: %s'
-                        % (table.bufferFileName, e))
+            load(table.bufferFile,table)
         else:
             try:
                 table.bufferFile.close()
@@ -192,16 +377,29 @@ def shutdown(dbapi,**connectionArgs):
         # close any open trace
         table.trace(enable=False)
     cursor.close()
-    db.commit()
+    try:
+        db.commit()
+        print("database: tables flushed")
+    except Exception as e:
+        # nothing was committed so spool every in-memory buffer for bin/flushTables
+        # and keep every buffer file
+        log.err('shutdown commit failed with error: %s' % e)
+        for bufferFile in loaded:
+            if inMemory(bufferFile):
+                spoolBuffer(bufferFile)
+            bufferFile.close()
+        loaded = [ ]
     db.close()
-    print("database: tables flushed")
 
-    for f in tableFiles:
+    for bufferFile in loaded:
+        bufferFile.close()
+        if inMemory(bufferFile):
+            continue
         try:
-            os.unlink(f)
+            os.unlink(bufferFile.name)
         except Exception as e:
             log.err('shutdown deleting table file %s failed with error: %s'
-                    % (f, e))
+                    % (bufferFile.name, e))
     print('database: shutdown complete')
 
 def executeSQL(transaction,statements,table):
@@ -212,89 +410,307 @@ def executeSQL(transaction,statements,table):
         transaction.execute(statement)
     return table
 
-def loadFile(transaction,bufferFile,table, doDelete=True):
+def loadFile(transaction,bufferFile,table,doDelete=True,savepoint=False):
     """
-    Loads the contents of an ASCII file into a database table
+    Loads the contents of a buffer file into a database table
     
     This function runs in a separate thread and so must not depend on
     any table attributes that might be modified elsewhere. In
     particular, we only read table.name here and do not modify any table
-    attributes.
+    attributes. An in-memory buffer is streamed directly and any rows
+    that cannot be loaded are spooled to the buffer's file name so that
+    they can be recovered later with bin/flushTables. Set savepoint when
+    several loads share one transaction, so that one failed load does
+    not abort the others.
     """
-    bufferFileName = bufferFile.name
+    loaded = copyBuffer(transaction,bufferFile,table,savepoint)
+    if loaded and doDelete and not inMemory(bufferFile):
+        os.unlink(bufferFile.name)
     bufferFile.close()
-    if Table.insertStatement is not None:
-        statement = Table.insertStatement.substitute(
-            file=bufferFileName,table=table.name)
-        try:
+    return table
+
+def copyBuffer(transaction,bufferFile,table,savepoint=False):
+    """
+    Copies the contents of a buffer file into a database table
+
+    Runs in a separate thread, like loadFile, and returns True if the rows were
+    copied. Otherwise the error is logged, any savepoint is rolled back and an
+    in-memory buffer is spooled to its file name. The buffer is left open so
+    that it can still be spooled if the enclosing transaction fails to commit.
+    """
+    bufferFileName = bufferFile.name
+    try:
+        if savepoint:
+            transaction.execute('savepoint load')
+        if Table.copyFormat == 'binary' and not bufferFile.closed:
+            bufferFile.write(binaryTrailer)
+        if inMemory(bufferFile):
+            bufferFile.seek(0)
+            transaction.copy_expert(copyStatement(table),bufferFile)
+        elif Table.insertStatement is not None:
+            bufferFile.close()
+            statement = Table.insertStatement.substitute(
+                file=bufferFileName,table=table.name)
             transaction.execute(statement)
-            if doDelete:
-                os.unlink(bufferFileName)
-        except Exception as e:
-            log.err('database.loadFile failed for %s with error: %s (see below for details)'
-                    % (bufferFileName,e.__class__.__name__))
-            log.err(str(e))
-    else:
-        # The substitution failed, so construct and execute our own cursor.copy_from() command.
-        statement = "COPY %s FROM STDIN CSV QUOTE ''''" % table.name
-        try:
-            with open(bufferFileName, 'r') as f:
-                transaction.copy_expert(statement, f)
-            if doDelete:
-                os.unlink(bufferFileName)
-        except Exception as e:
-            log.err('database.loadFile failed for %s with error: %s (see below for details)'
-                    % (bufferFileName,e.__class__.__name__))
-            log.err(str(e))
+        else:
+            # The substitution failed, so construct and execute our own cursor.copy_from() command.
+            bufferFile.close()
+            mode = 'rb' if Table.copyFormat == 'binary' else 'r'
+            with open(bufferFileName, mode) as f:
+                transaction.copy_expert(copyStatement(table), f)
+        if savepoint:
+            transaction.execute('release savepoint load')
+        return True
+    except Exception as e:
+        log.err('database.loadFile failed for %s with error: %s (see below for details)'
+                % (bufferFileName,e.__class__.__name__))
+        log.err(str(e))
+        if savepoint:
+            try:
+                transaction.execute('rollback to savepoint load')
+            except Exception as e:
+                # the whole transaction will fail, which groupFailed handles
+                log.err('database.loadFile rollback failed for %s with error: %s'
+                        % (bufferFileName,e))
+        if inMemory(bufferFile):
+            spoolBuffer(bufferFile)
+        return False
 
-    return table
+def loadGroup(transaction,batch):
+    """
+    Loads a batch of (bufferFile,table,nRows) buffers in a single transaction
+
+    Runs in a separate thread, like loadFile. Returns a list of flags that are
+    True for each buffer that was loaded. The buffers are closed, and loaded
+    buffer files deleted, by Table.releaseGroup once the transaction commits.
+    """
+    return [ copyBuffer(transaction,bufferFile,table,savepoint=True)
+        for bufferFile,table,nRows in batch ]
 
-def ping(options):
+def inMemory(bufferFile):
+    """
+    Returns True if a table buffer is held in memory rather than in a file
+    """
+    return isinstance(bufferFile,(io.StringIO,io.BytesIO))
+
+def spillBuffer(bufferFile):
+    """
+    Moves the contents of an in-memory buffer to a file of the same name
+
+    Returns the new file, already closed by closeBuffer.
+    """
+    spilled = open(bufferFile.name,'wb' if Table.copyFormat == 'binary' else 'w')
+    spilled.write(bufferFile.getvalue())
+    bufferFile.close()
+    return closeBuffer(spilled)
+
+def closeBuffer(bufferFile):
+    """
+    Completes and closes a buffer file that is waiting to be loaded
+
+    This keeps queued buffers from holding file descriptors. Loads open
+    closed buffer files again by name.
+    """
+    if Table.copyFormat == 'binary':
+        bufferFile.write(binaryTrailer)
+    bufferFile.close()
+    return bufferFile
+
+def spoolBuffer(bufferFile):
+    """
+    Writes the contents of an in-memory buffer to its spool file
+    """
+    mode = 'wb' if Table.copyFormat == 'binary' else 'w'
+    try:
+        with open(bufferFile.name,mode) as f:
+            f.write(bufferFile.getvalue())
+        log.msg('database: spooled unloaded rows to %s' % bufferFile.name)
+    except Exception as e:
+        log.err('database.spoolBuffer failed for %s with error: %s'
+                % (bufferFile.name,e))
+
+def copyStatement(table):
+    """
+    Returns the postgres COPY statement that loads buffered rows into a table
+    """
+    if Table.copyFormat == 'binary':
+        return "COPY %s FROM STDIN (FORMAT binary)" % table.name
+    else:
+        return "COPY %s FROM STDIN CSV QUOTE ''''" % table.name
+
+def ping():
     """
     Performs periodic database maintenance
+
+    Flushes every table whose flush deadline has passed, so that no buffered
+    row waits longer than the max-age option (plus one ping interval) however
+    many tables are active.
     """
-    if not Table.lastActivity:
-        return
     now = time.time()
-    idleTime = now - Table.lastActivity
-    # print 'Last activity was %.3f secs ago' % idleTime
-    if idleTime < options.idleTime:
-        return
-    # find table that has been idle longest
-    maxIdler = None
-    maxIdleTime = 0
-    for table in Table.registry.values():
-        idleTime = now - table.lastActivity
-        if idleTime > maxIdleTime and len(table.rowBuffer) > 0 and not table.busy:
-            maxIdler = table
-            maxIdleTime = idleTime
-    if maxIdler and not maxIdler.busy:
-        print('Flushing table %s idle for %.3f secs' % (maxIdler.name,idleTime))
-        maxIdler.flushBuffer()
-        maxIdler.openBuffer()
+    retry = [ ]
+    while Table.deadlines and Table.deadlines[0][0] <= now:
+        entry = heapq.heappop(Table.deadlines)
+        table = entry[2]
+        if table.flushDeadline is not entry:
+            # this table has already been flushed since the entry was scheduled
+            continue
+        if table.busy:
+            # try again on the next ping once the current flush has completed
+            retry.append(entry)
+            continue
+        table.flushBuffer()
+        table.openBuffer()
+    for entry in retry:
+        heapq.heappush(Table.deadlines,entry)
 
 class Table(object):
     
     connectionPool = None
     bufferPath = None
     insertStatement = None
+    copyFormat = 'csv'
+    bufferMode = 'file'
+
+    # buffered rows are flushed no later than maxAge seconds after they are
+    # recorded, using a heap of (deadline,sequence,table) flush deadlines
+    maxAge = None
+    deadlines = [ ]
+    sequence = itertools.count()
+
+    # buffers flushed within groupWindow seconds of each other are loaded
+    # together in a single transaction when groupWindow is positive
+    groupWindow = 0
+    group = [ ]
+
+    # when latencyTarget is positive, each table's buffer size is adapted to the
+    # number of rows it receives in latencyTarget seconds, within these bounds,
+    # using an exponentially weighted moving average of its row rate
+    latencyTarget = 0
+    minBufferSize = 1
+    maxBufferSize = 1000
+    rateWeight = 0.25
+
+    # each table can hand up to maxInFlight buffers to the database at once and
+    # spills buffers to disk when it has more than bufferLimit rows waiting,
+    # until maxQueued buffers are waiting
+    maxInFlight = 1
+    bufferLimit = 100000
+    maxQueued = 100
+
+    # flush statistics
+    commits = 0
+    loads = 0
+    loadedRows = 0
+    largestGroup = 0
 
     existing = { }
     registry = { }
 
     lastActivity = None
 
+    # tables that filled up during the current (possibly nested) batch of rows, if any
+    batch = None
+    batchDepth = 0
+
+    @staticmethod
+    def beginBatch():
+        """
+        Defers flushing any tables that fill up until endBatch is called
+        """
+        if Table.batch is None:
+            Table.batch = set()
+        Table.batchDepth += 1
+
     @staticmethod
-    def release(table):
+    def endBatch():
         """
-        Clears this table's busy flag
+        Flushes any tables that filled up since the outermost beginBatch
+        """
+        Table.batchDepth -= 1
+        if Table.batchDepth:
+            return
+        batch,Table.batch = Table.batch,None
+        for table in batch or ():
+            table.flushIfFull()
+
+    @staticmethod
+    def release(table,bufferFile):
+        """
+        Records that one of this table's buffers has been loaded
         
         Normally invoked as a twisted Deferred callback.
         """
+        table.pendingTAI.pop(bufferFile,None)
         if table.traceEnable:
             print("OUT %d %f" % (
                 table.traceOut,time.time()-table.traceStart), file=table.traceFile)
-        table.busy = False
+        table.inFlight -= 1
+        table.loadQueued()
+        # flush our current buffer now if it filled up while we were busy
+        if len(table.rowBuffer) >= table.bufferSize and not table.busy:
+            table.flushBuffer()
+            table.openBuffer()
+
+    @staticmethod
+    def schemaReady(table):
+        """
+        Allows this table's buffers to be loaded once its schema is up to date
+        
+        Normally invoked as a twisted Deferred callback.
+        """
+        table.schemaBusy = False
+        if not table.ready.called:
+            table.ready.callback(table)
+        table.loadQueued()
+
+    @staticmethod
+    def releaseGroup(loaded,batch):
+        """
+        Records that each buffer in a group commit has been loaded
+        
+        Normally invoked as a twisted Deferred callback. Buffer files whose rows
+        failed to load are kept so that they can be recovered with bin/flushTables.
+        """
+        for ok,(bufferFile,table,nRows) in zip(loaded,batch):
+            bufferFile.close()
+            if ok and not inMemory(bufferFile):
+                os.unlink(bufferFile.name)
+            Table.release(table,bufferFile)
+
+    @staticmethod
+    def groupFailed(reason,batch):
+        """
+        Spools the buffers of a group commit that failed and releases their tables
+
+        Normally invoked as a twisted Deferred errback. Rows already copied in
+        the failed transaction were not committed, so every in-memory buffer is
+        spooled to its file name for recovery with bin/flushTables.
+        """
+        log.err(reason,'database: group commit of %d buffers failed' % len(batch))
+        for bufferFile,table,nRows in batch:
+            if inMemory(bufferFile) and not bufferFile.closed:
+                spoolBuffer(bufferFile)
+            bufferFile.close()
+            Table.release(table,bufferFile)
+
+    @staticmethod
+    def commitGroup():
+        """
+        Loads all buffers waiting for a group commit in a single transaction
+        """
+        batch,Table.group = Table.group,[ ]
+        Table.loadBatch(batch)
+
+    @staticmethod
+    def loadBatch(batch):
+        """
+        Loads a batch of (bufferFile,table,nRows) buffers in a single transaction
+        """
+        Table.commits += 1
+        Table.largestGroup = max(Table.largestGroup,len(batch))
+        Table.connectionPool.runInteraction(loadGroup,batch).addCallbacks(
+            Table.releaseGroup,Table.groupFailed,
+            callbackArgs=(batch,),errbackArgs=(batch,))
         
     @staticmethod
     def prepareColumnNames(columnTypes):
@@ -405,11 +821,22 @@ class Table(object):
         """
         self.name = name.lower()
         self.columnTypes = columnTypes
-        self.busy = False
+        self.schemaBusy = False
+        self.ready = defer.Deferred()
+        self.inFlight = 0
+        self.queued = collections.deque()
+        # the TAI of the oldest row in each buffer that is queued or being loaded
+        self.pendingTAI = { }
+        self.flushDeadline = None
+        self.rowRate = None
         self.traceEnable = False
         # convert the coulumn types into a list of SQL column names
         self.aliases,self.columnNames,self.columnFinalTypes = (
             Table.prepareColumnNames(columnTypes))
+        # the column holding each row's TAI timestamp, if any
+        self.taiColumn = self.columnNames.index('tai') if 'tai' in self.columnNames else None
+        # build the function that will format our rows for the database
+        self.encodeRow = rowEncoder(self.columnFinalTypes,Table.copyFormat == 'binary')
         # does the database already contain a table with this name?
         if self.name in Table.existing:
             (nRows,existingColumnNames) = Table.existing[self.name]
@@ -440,6 +867,9 @@ class Table(object):
         # record this newly initialized table in our registry
         Table.registry[self.name] = self
         self.recordActivity()
+        # we are ready now unless our schema is still being updated
+        if not self.schemaBusy and not self.ready.called:
+            self.ready.callback(self)
 
     def recordActivity(self):
         """
@@ -470,74 +900,185 @@ class Table(object):
 
     def openBuffer(self):
         self.rowBuffer = [ ]
+        self.bufferOpened = time.time()
         self.bufferFileName = os.path.join(
             Table.bufferPath,'%s_%d' % (self.name,self.nFlushes))
-        self.bufferFile = open(self.bufferFileName,'w')
+        binary = (Table.copyFormat == 'binary')
+        if Table.bufferMode == 'memory':
+            # rows accumulate in memory and are only written to bufferFileName
+            # if they cannot be loaded into the database
+            self.bufferFile = io.BytesIO() if binary else io.StringIO()
+            self.bufferFile.name = self.bufferFileName
+        else:
+            self.bufferFile = open(self.bufferFileName,'wb' if binary else 'w')
+        if binary:
+            self.bufferFile.write(binaryHeader)
         
-    def flushBuffer(self):
+    def scheduleFlush(self,deadline):
+        """
+        Schedules this table to be flushed by the periodic ping task
+        """
+        self.flushDeadline = (deadline,next(Table.sequence),self)
+        heapq.heappush(Table.deadlines,self.flushDeadline)
+
+    def adaptBufferSize(self):
+        """
+        Updates our row rate estimate and resizes our buffer to match
+        """
+        elapsed = time.time() - self.bufferOpened
+        if elapsed <= 0 or not self.rowBuffer:
+            return
+        rate = len(self.rowBuffer)/elapsed
+        if self.rowRate is None:
+            self.rowRate = rate
+        else:
+            self.rowRate += Table.rateWeight*(rate - self.rowRate)
+        self.bufferSize = min(Table.maxBufferSize,
+            max(Table.minBufferSize,int(self.rowRate*Table.latencyTarget)))
+
+    def bufferedSince(self):
+        """
+        Returns the TAI of the oldest row in our current buffer or None
+        """
+        if self.taiColumn is None or not self.rowBuffer:
+            return None
+        return self.rowBuffer[0][self.taiColumn]
+
+    def unloadedSince(self):
+        """
+        Returns the TAI of the oldest of our rows not yet loaded into the database or None
+        """
+        pending = list(self.pendingTAI.values())
+        since = self.bufferedSince()
+        if since is not None:
+            pending.append(since)
+        return min(pending) if pending else None
+
+    @property
+    def busy(self):
+        """
+        True if we cannot hand another buffer to the database right now
+        """
+        return self.schemaBusy or self.inFlight >= Table.maxInFlight
+
+    def flushBuffer(self,spill=False):
+        """
+        Queues our current buffer to be loaded into the database
+
+        The caller must open a new buffer after this. Set spill to move an
+        in-memory buffer to disk while it waits to be loaded.
+        """
         if len(self.rowBuffer) > 5:
             print('%s: flushing %d rows' % (self.name,len(self.rowBuffer)))
+        if Table.latencyTarget > 0:
+            self.adaptBufferSize()
         self.nFlushes += 1
-        self.busy = True
+        self.flushDeadline = None
         if self.traceEnable:
             print("OUT %d %f" % (
                 self.traceOut,time.time()-self.traceStart), file=self.traceFile)
             self.traceOut += len(self.rowBuffer)
-        if Table.connectionPool:
-            Table.connectionPool.runInteraction(
-                loadFile,self.bufferFile,self).addCallback(Table.release)
-        else:
-            self.bufferFile.close()
-            Table.release(self)
+        bufferFile = self.bufferFile
+        if spill and inMemory(bufferFile):
+            bufferFile = spillBuffer(bufferFile)
+        elif not inMemory(bufferFile):
+            closeBuffer(bufferFile)
+        since = self.bufferedSince()
+        if since is not None:
+            self.pendingTAI[bufferFile] = since
+        self.queued.append((bufferFile,len(self.rowBuffer)))
+        self.loadQueued()
+
+    def dropBuffer(self):
+        """
+        Discards our current buffer without loading it
+
+        The caller must open a new buffer after this.
+        """
+        log.err('%s: dropping %d rows with %d buffers already waiting to load' % (
+            self.name,len(self.rowBuffer),len(self.queued)))
+        self.flushDeadline = None
+        self.bufferFile.close()
+        if not inMemory(self.bufferFile):
+            os.unlink(self.bufferFile.name)
+        self.nFlushes += 1
+
+    def loadQueued(self):
+        """
+        Hands queued buffers to the database, oldest first, while we are not busy
+        """
+        while self.queued and not self.busy:
+            bufferFile,nRows = self.queued.popleft()
+            if not Table.connectionPool:
+                self.pendingTAI.pop(bufferFile,None)
+                bufferFile.close()
+                continue
+            self.inFlight += 1
+            Table.loads += 1
+            Table.loadedRows += nRows
+            if Table.groupWindow > 0:
+                # wait for other tables to join this group before loading it
+                if not Table.group:
+                    from twisted.internet import reactor
+                    reactor.callLater(Table.groupWindow,Table.commitGroup)
+                Table.group.append((bufferFile,self,nRows))
+            else:
+                Table.loadBatch([ (bufferFile,self,nRows) ])
 
     def record(self,*rowValues):
         """
         Records one new row of values
         """
-        rowString = ''
-        for index,colName in enumerate(self.columnNames):
-            storage = self.columnFinalTypes[index].storage.lower()
-            # We might have fewer values than columns if the last columnType is
-            # repeated with variable length.
-            try:
-                value = rowValues[index]
-            except IndexError:
-                value = types.InvalidValue
-            if index:
-                rowString += ','
-            if value is types.InvalidValue:
-                # leave this field empty to signal a NULL SQL value
-                pass
-            elif hasattr(value,'storageValue'):
-                rowString += value.storageValue()
-            elif storage == 'text':
-                rowString += "'%s'" % value.replace("'","''")
-            elif storage[:3] == 'int':
-                if isinstance(type(value),types.UInt) and (value & 0x80000000):
-                    # interpret the MSB as a sign bit to encode a UInt as as an Int
-                    encoded = -(int(value)&0x7fffffff)
-                    rowString += str(encoded)
-                else:
-                    rowString += str(int(value))
-            elif storage[:3] == 'flt':
-                rowString += repr(float(value))
-        print(rowString, file=self.bufferFile)
+        self.recordEncoded(self.encodeRow(rowValues),rowValues)
+
+    def recordEncoded(self,encoded,rowValues):
+        """
+        Records one new row of values that has already been encoded by encodeRow
+        """
+        self.bufferFile.write(encoded)
         self.rowBuffer.append(rowValues)
+        self.rowAdded()
+
+    def rowAdded(self):
+        """
+        Updates this table after a new row has been written to its buffer
+        """
         self.nRows += 1
         # record the time of this table activity
         self.recordActivity()
+        # the first row after a flush sets the deadline for the next flush
+        if self.flushDeadline is None and Table.maxAge is not None:
+            self.scheduleFlush(self.lastActivity + Table.maxAge)
         # trace this table write
         if self.traceEnable:
             print("IN %d %f" % (
                 self.nRows-self.traceRows,self.lastActivity-self.traceStart), file=self.traceFile)
-        # flush this table now?
+        # flush this table now, or at the end of the current batch?
         if len(self.rowBuffer) >= self.bufferSize:
-            if self.busy:
-                if len(self.rowBuffer) > 5:
-                    print('delaying flush of %d rows to %s' % (len(self.rowBuffer),self.name))
+            if Table.batch is not None:
+                Table.batch.add(self)
             else:
+                self.flushIfFull()
+
+    def flushIfFull(self):
+        """
+        Flushes our current buffer if it is full and we are able to
+        """
+        if len(self.rowBuffer) >= self.bufferSize:
+            if not self.busy:
                 self.flushBuffer()
                 self.openBuffer()
+            elif len(self.rowBuffer) >= Table.bufferLimit:
+                if len(self.queued) < Table.maxQueued:
+                    # stop this buffer growing without bound while our flushes are in flight
+                    print('spilling %d rows to %s while %d flushes are in flight' % (
+                        len(self.rowBuffer),self.name,self.inFlight))
+                    self.flushBuffer(spill=True)
+                    self.openBuffer()
+                elif len(self.rowBuffer) >= 2*Table.bufferLimit:
+                    # the database has stalled so keep our memory and disk usage bounded
+                    self.dropBuffer()
+                    self.openBuffer()
 
     def create(self,indices=None):
         """
@@ -570,12 +1111,12 @@ class Table(object):
             colName = self.columnNames[self.aliases.index(name)]
             statements.append('create index %s_%s on %s(%s)'
                 % (self.name,colName,self.name,colName))
-        self.busy = True
+        self.schemaBusy = True
         if Table.connectionPool:
             Table.connectionPool.runInteraction(
-                executeSQL,statements,self).addCallback(Table.release)
+                executeSQL,statements,self).addCallback(Table.schemaReady)
         else:
-            Table.release(self)
+            Table.schemaReady(self)
 
     def tryToAlterTable(self, existing=None):
         global sqlTypes
@@ -593,18 +1134,31 @@ class Table(object):
             sql = "%s %s %s" % (sql0, colName,sqlType)
             statements.append(sql)
             
-        self.busy = True
+        self.schemaBusy = True
         if Table.connectionPool:
             Table.connectionPool.runInteraction(
-                executeSQL,statements,self).addCallback(Table.release)
+                executeSQL,statements,self).addCallback(Table.schemaReady)
         else:
-            Table.release(self)
+            Table.schemaReady(self)
 
         raise DatabaseException(
             "Incompatible column definitions for %s:\nNEW: %s\n DB: %s" %
             (self.name,self.columnNames,existing)
         )
         
+def typedRow(rowRaw,vtypes):
+    """
+    Returns a row fetched from a key table as its timestamp and typed values
+    """
+    # the first value is always a TAI timestamp in MJD seconds
+    rowTyped = [columns.taiTimestamp(rowRaw[0])]
+    for vtype,value in zip(vtypes[1:],rowRaw[1:]):
+        if value is None:
+            rowTyped.append(types.InvalidValue)
+        else:
+            rowTyped.append(vtype(value))
+    return rowTyped
+
 def keyTableFetch(transaction,sql,vtypes,data = None):
     """
     Starts a database transaction to load rows from a key table
@@ -619,14 +1173,7 @@ def keyTableFetch(transaction,sql,vtypes,data = None):
         transaction.execute(sql)
         print('transaction finished')
         for rowRaw in transaction.fetchall():
-            # the first value is always a TAI timestamp in MJD seconds
-            rowTyped = [astrotime.AstroTime.fromMJD(rowRaw[0],86400.)/astrotime.TAI]
-            for vtype,value in zip(vtypes[1:],rowRaw[1:]):
-                if value is None:
-                    rowTyped.append(types.InvalidValue)
-                else:
-                    rowTyped.append(vtype(value))
-            data.append(rowTyped)
+            data.append(typedRow(rowRaw,vtypes))
         print('data appended')
         return data
     except:
@@ -635,10 +1182,208 @@ def keyTableFetch(transaction,sql,vtypes,data = None):
         log.err()
         return data
 
+def keyTableFetchChunks(transaction,sql,vtypes):
+    """
+    Starts a database transaction to load (tai,row) pairs from a key table
+
+    Runs in a separate thread using the twisted dbapi connection pool. Unlike
+    keyTableFetch, errors are not caught so that partial results are never cached.
+    """
+    transaction.execute(sql)
+    return [ (rowRaw[0],typedRow(rowRaw,vtypes)) for rowRaw in transaction.fetchall() ]
+
+def keyTableStream(transaction,sql,vtypes,consumer,batchSize,layout = None):
+    """
+    Starts a database transaction to stream rows from a key table in batches
+
+    Runs in a separate thread using the twisted dbapi connection pool. Each batch
+    of at most batchSize typed rows is passed to consumer in the reactor thread,
+    and the next batch is only fetched once consumer has returned (or its
+    deferred result has fired), so memory use is bounded by the batch size
+    rather than the size of the result. Batches are decoded into a
+    columns.ColumnBatch instead when a column layout is passed in.
+    Returns the number of rows streamed.
+    """
+    from twisted.internet import reactor
+    if Table.serverCursors:
+        # keep the result on the server and fetch it one batch at a time
+        transaction.execute('declare key_stream no scroll cursor for ' + sql.rstrip(';'))
+        fetch = 'fetch forward %d from key_stream' % batchSize
+    else:
+        transaction.execute(sql)
+        fetch = None
+    nRows = 0
+    while True:
+        if fetch:
+            transaction.execute(fetch)
+            batch = transaction.fetchall()
+        else:
+            batch = transaction.fetchmany(batchSize)
+        if not batch:
+            break
+        nRows += len(batch)
+        if layout is None:
+            batch = [ typedRow(rowRaw,vtypes) for rowRaw in batch ]
+        else:
+            batch = columns.fetchedBatch(layout,batch)
+        threads.blockingCallFromThread(reactor,consumer,batch)
+    if fetch:
+        transaction.execute('close key_stream')
+    return nRows
+
+def cursorRows(transaction,name,sql,batchSize):
+    """
+    Returns an iterator over the rows of a query fetched in batches
+
+    With postgres, each query uses its own named server-side cursor so that
+    several queries can be read in step within one transaction. Otherwise the
+    whole result is fetched immediately.
+    """
+    if not Table.serverCursors:
+        transaction.execute(sql)
+        return iter(transaction.fetchall())
+    transaction.execute('declare %s no scroll cursor for %s' % (name,sql.rstrip(';')))
+    return cursorBatches(transaction,name,batchSize)
+
+def cursorBatches(transaction,name,batchSize):
+    """
+    Yields the rows of a declared cursor, fetching batchSize rows at a time
+    """
+    fetch = 'fetch forward %d from %s' % (batchSize,name)
+    while True:
+        transaction.execute(fetch)
+        batch = transaction.fetchall()
+        if not batch:
+            break
+        for rowRaw in batch:
+            yield rowRaw
+    transaction.execute('close %s' % name)
+
+def keyTablesMerge(transaction,queries,consumer,batchSize):
+    """
+    Starts a database transaction to stream the rows of several key tables in TAI order
+
+    Runs in a separate thread using the twisted dbapi connection pool. Each query
+    is a (keytag,sql,vtypes,buffered) tuple whose sql selects raw IDs, timestamps
+    and values in TAI order, followed by the typed rows copied from the table's
+    buffer as (tai,rawID,row) tuples. The queries are read in step through their
+    own cursors and merged with a k-way heap merge, so memory use is bounded by
+    the number of tables and the batch size. Batches of (keytag,row) pairs are
+    passed to consumer in the reactor thread, as in keyTableStream. Rows with
+    the same timestamp are ordered by raw ID and never dropped.
+    Returns the number of rows streamed.
+    """
+    from twisted.internet import reactor
+    streams = [ ]
+    for index,(keytag,sql,vtypes,buffered) in enumerate(queries):
+        rows = cursorRows(transaction,'key_merge_%d' % index,sql,batchSize)
+        fetched = ((rowRaw[1],rowRaw[0],index,typedRow(rowRaw[1:],vtypes)) for rowRaw in rows)
+        streams.append(itertools.chain(fetched,
+            ((tai,rawID,index,row) for tai,rawID,row in buffered)))
+    keytags = [ query[0] for query in queries ]
+    nRows = 0
+    batch = [ ]
+    for tai,rawID,index,row in heapq.merge(*streams):
+        batch.append((keytags[index],row))
+        if len(batch) == batchSize:
+            threads.blockingCallFromThread(reactor,consumer,batch)
+            nRows += len(batch)
+            batch = [ ]
+    if batch:
+        threads.blockingCallFromThread(reactor,consumer,batch)
+        nRows += len(batch)
+    return nRows
+
+def keyTablePage(transaction,sql,vtypes):
+    """
+    Starts a database transaction to load (rawID,row) pairs from a key table
+
+    Runs in a separate thread using the twisted dbapi connection pool.
+    """
+    transaction.execute(sql)
+    return [ (rowRaw[0],typedRow(rowRaw[1:],vtypes)) for rowRaw in transaction.fetchall() ]
+
+def encodePageToken(beginMJDsecs,endMJDsecs,bound,ascending):
+    """
+    Returns an opaque token that continues a paged date range query after bound
+    """
+    packed = struct.pack('!ddq?',beginMJDsecs,endMJDsecs,bound,ascending)
+    return base64.urlsafe_b64encode(packed).rstrip(b'=').decode('ascii')
+
+def decodePageToken(token):
+    """
+    Returns the (begin,end,bound,ascending) of a paged query from its token
+    """
+    try:
+        token = token.encode('ascii')
+        return struct.unpack('!ddq?',base64.urlsafe_b64decode(token + b'='*(-len(token)%4)))
+    except (ValueError,UnicodeError,binascii.Error,struct.error):
+        raise DatabaseException('Invalid page token')
+
+def pageResult(pairs,beginMJDsecs,endMJDsecs,ascending,pageSize):
+    """
+    Returns the values of up to pageSize (rawID,value) pairs and a next page token
+
+    The pairs must be ordered by raw ID and include at least one extra pair when
+    there are more pages, otherwise the token is None. Pairs with the same raw ID,
+    from different key tables, are never split across pages.
+    """
+    if len(pairs) <= pageSize:
+        return [ value for rawID,value in pairs ],None
+    end = pageSize
+    while end > 1 and pairs[end][0] == pairs[end-1][0]:
+        end -= 1
+    values = [ value for rawID,value in pairs[:end] ]
+    return values,encodePageToken(beginMJDsecs,endMJDsecs,pairs[end-1][0],ascending)
+
+def rollupState(transaction,sql):
+    """
+    Starts a database transaction to load the first bucket and last row of a rollup
+
+    Runs in a separate thread using the twisted dbapi connection pool. Returns
+    None for an empty rollup table.
+    """
+    transaction.execute(sql)
+    return transaction.fetchone()
+
+def keyTableReduce(transaction,sql,reducer,batchSize=1000):
+    """
+    Starts a database transaction to stream (tai,value) rows into a reducer
+
+    Runs in a separate thread using the twisted dbapi connection pool. Rows are
+    fetched in batches through a server-side cursor so that only the reducer
+    grows with the query. Errors are passed on to the caller's errback rather
+    than returning a partly filled reducer.
+    """
+    for tai,value in cursorRows(transaction,'key_reduce',sql,batchSize):
+        reducer.add(tai,value)
+    return reducer
+
 class KeyTable(Table):
     """
     Stores the values associated with a specific keyword in a database table
     """
+    # the storage policy that filters this keyword's values, if any
+    policy = None
+
+    # the rollups of this keyword's values, from finest to coarsest
+    rollups = ( )
+
+    # byDate uses the coarsest rollup with at least this many buckets in a long interval
+    rollupPoints = 100
+
+    # streamByDate delivers rows in batches of this many
+    streamBatch = 1000
+
+    # streamByDate delivers columns.ColumnBatch batches instead of typed rows?
+    columnar = False
+
+    # the cache of settled rows shared by all key tables, if any
+    queryCache = None
+
+    # rows are only settled, so cacheable, once they are this many seconds old
+    settleDelay = 300.
+
     @staticmethod
     def name(actorName,keyName):
         """
@@ -661,7 +1406,14 @@ class KeyTable(Table):
     def attach(actor,key):
         """
         Attaches a keyword's database table, creating it if necessary.
+
+        The attached table is cached in the key object so that only the first
+        attach of each key needs to do any work.
         """
+        try:
+            return key.keyTable
+        except AttributeError:
+            pass
         # construct this table's canonical name
         tableName = KeyTable.name(actor.name,key.name)
         # construct a tuple of column types for this keyword's value, prepended
@@ -670,102 +1422,659 @@ class KeyTable(Table):
         if not hasattr(key,'columnTypes'):
             colTypes = [ types.Long(name='raw_id') ]
             colTypes.extend(key.typedValues.vtypes)
-            # cache the tuple in the key object to speed up future attach operations
             key.columnTypes = tuple(colTypes)
         # attach the table now
         keyTable = Table.attach(tableName,key.columnTypes,bufferSize=KeyTable.bufferSize,
             tableClass=KeyTable)
         keyTable.tag = '%s.%s' % (actor.name,key.name)
-        # construct this table's SQL select statement preamble
-        rawTable = Table.attach('reply_raw')
-        keyTable.selector = 'select raw.%s' % rawTable.columnNames[1]
-        for colName in keyTable.columnNames[1:]:
-            keyTable.selector += ',key.%s' % colName
-        keyTable.selector += ' from %s raw, %s key' % (rawTable.name,keyTable.name)
-        keyTable.selector += ' where raw.%s=key.%s' % (
-            rawTable.columnNames[0],keyTable.columnNames[0])
-        keyTable.selectLimit = ' order by key.%s desc limit %%d;' % keyTable.columnNames[0]
-        keyTable.noDuplicates = ' and key.%s < %%ld' % keyTable.columnNames[0]
-        keyTable.selectAfter = ' and raw.%s > %%r' % rawTable.columnNames[1]
-        keyTable.selectBefore = ' and raw.%s <= %%r' % rawTable.columnNames[1]
+        keyTable.policy = policy.forKey(actor.name,key.name)
+        keyTable.rollups = Rollup.forTable(keyTable)
+        keyTable.prepareQueries()
+        # cache the table in the key object to speed up future attach operations
+        key.keyTable = keyTable
         return keyTable
+
+    def prepareQueries(self):
+        """
+        Constructs this table's SQL select statement fragments
+        """
+        rawTable = Table.attach('reply_raw')
+        self.selector = 'select raw.%s' % rawTable.columnNames[1]
+        for colName in self.columnNames[1:]:
+            self.selector += ',key.%s' % colName
+        self.selector += ' from %s raw, %s key' % (rawTable.name,self.name)
+        self.selector += ' where raw.%s=key.%s' % (
+            rawTable.columnNames[0],self.columnNames[0])
+        self.selectLimit = ' order by key.%s desc limit %%d;' % self.columnNames[0]
+        self.noDuplicates = ' and key.%s < %%ld' % self.columnNames[0]
+        self.selectAfter = ' and raw.%s > %%r' % rawTable.columnNames[1]
+        self.selectBefore = ' and raw.%s <= %%r' % rawTable.columnNames[1]
+        self.selectByTime = ' order by raw.%s desc limit %%d;' % rawTable.columnNames[1]
+        self.selectInOrder = ' order by key.%s;' % self.columnNames[0]
+        self.pageSelector = self.selector.replace('select ','select key.%s,' % self.columnNames[0],1)
+        self.pageAfter = ' and key.%s > %%ld' % self.columnNames[0]
+        self.pageAscending = ' order by key.%s limit %%d;' % self.columnNames[0]
+        self.selectTimeOrder = ' order by raw.%s,key.%s;' % (
+            rawTable.columnNames[1],self.columnNames[0])
+        self.columnSelector = 'select raw.%s,key.%%s from %s raw, %s key where raw.%s=key.%s' % (
+            rawTable.columnNames[1],rawTable.name,self.name,
+            rawTable.columnNames[0],self.columnNames[0])
         
+    def encodeValues(self,rowValues):
+        """
+        Encodes a row of values without its raw ID for use with encodeRawID
+
+        This allows the encoding of values that are repeated in many rows to be reused.
+        """
+        encoded = self.encodeRow((0,)+tuple(rowValues))
+        if Table.copyFormat == 'binary':
+            # skip the field count and the raw ID field
+            return encoded[2+4+8:]
+        return encoded[1:]
+
+    def encodeRawID(self,rawID,encodedValues):
+        """
+        Returns the encoded row for a raw ID and values encoded by encodeValues
+        """
+        if Table.copyFormat == 'binary':
+            return struct.pack('!hiq',len(self.columnFinalTypes),8,rawID) + encodedValues
+        return str(rawID) + encodedValues
+
+    @staticmethod
+    def dateRange(interval,endAt):
+        """
+        Returns the (begin,end) TAI MJD seconds of an interval ending at endAt
+
+        The endAt value is either 'now' or TAI seconds since the unix epoch.
+        """
+        if endAt == 'now':
+            endAtMJDsecs = KeyTable.clock()
+        else:
+            endAtMJDsecs = astrotime.AstroTime.utcfromtimestamp(endAt).MJD()*86400.
+        return endAtMJDsecs - interval,endAtMJDsecs
+
     def byDate(self,interval,endAt):
         """
         Returns rows timestamped within the specified date range
         """
-        # convert endAt from TAI seconds since the unix epoch into MJD secs
-        if endAt == 'now':
-            timestamp = astrotime.AstroTime.now(tz=KeyTable.timestampTZ)
+        beginMJDsecs,endAtMJDsecs = KeyTable.dateRange(interval,endAt)
+        # use a rollup instead for an interval too long to return every row
+        rollup = self.chooseRollup(interval,beginMJDsecs)
+        if rollup is not None:
+            return rollup.byDate(beginMJDsecs,endAtMJDsecs,endAt == 'now')
+        # use the query cache for any settled chunks before a live tail
+        edge = self.settledEdge(beginMJDsecs,endAtMJDsecs)
+        if edge is None:
+            return self.fetchByDate(beginMJDsecs,endAtMJDsecs,endAt == 'now')
+        if edge < endAtMJDsecs:
+            result = self.fetchByDate(edge,endAtMJDsecs,endAt == 'now')
         else:
-            timestamp = astrotime.AstroTime.utcfromtimestamp(endAt)
-        endAtMJDsecs = timestamp.MJD()*86400.
-        beginMJDsecs = endAtMJDsecs - interval
+            result = defer.succeed([ ])
+        return result.addCallback(self.addChunks,beginMJDsecs,edge)
+
+    def fetchByDate(self,beginMJDsecs,endAtMJDsecs,toNow):
+        """
+        Returns our buffered and stored rows within a date range, most recent first
+        """
         # retrieve any cached rows that match this query
         cacheCopy = [ ]
-        if len(self.rowBuffer) > 0:
+        buffer = self.rowBuffer
+        if len(buffer) > 0:
             # lookup the timestamp (MJD secs) of the oldest cached row
-            cacheAge = self.taiCache[self.rowBuffer[0][0]].MJD()*86400.
+            cacheAge = buffer.tai[0]
             if cacheAge <= endAtMJDsecs:
                 # the cached rows overlap the query range
                 # copy matching rows, working from most recent to oldest
-                for cachedRow in self.rowBuffer[::-1]:
-                    rowMJDsecs = self.taiCache[cachedRow[0]].MJD()*86400.
-                    if rowMJDsecs < beginMJDsecs:
-                        break
-                    if rowMJDsecs <= endAtMJDsecs:
-                        cacheCopy.append(list(cachedRow))
-                        # replace rawIDs with timestamps
-                        cacheCopy[-1][0] = self.taiCache[cacheCopy[-1][0]]
+                begin,end = buffer.between(beginMJDsecs,endAtMJDsecs)
+                cacheCopy = [ buffer.row(index) for index in range(end-1,begin-1,-1) ]
             if cacheAge < beginMJDsecs:
                 # the cached rows fully cover the query range so no database query is needed
                 return defer.succeed(cacheCopy)
         # use the database to complete this query
         sql = self.selector
         # avoid duplicates in case the cache is flushed before our db query runs
-        if len(self.rowBuffer) > 0:
-            sql += self.noDuplicates % self.rowBuffer[0][0]
+        if len(buffer) > 0:
+            sql += self.noDuplicates % buffer.rawID[0]
         sql += self.selectAfter % beginMJDsecs
-        if endAt != 'now':
+        if not toNow:
             sql += self.selectBefore % endAtMJDsecs
         # return rows ordered with most recent first and limit to 1000 (including the cache)
         sql += self.selectLimit % (1000-len(cacheCopy))
         return Table.connectionPool.runInteraction(
             keyTableFetch,sql,self.columnFinalTypes,cacheCopy)
 
+    def streamByDate(self,interval,endAt,consumer):
+        """
+        Streams all of our rows within a date range to consumer, oldest first
+
+        Rows are passed to consumer in batches of at most streamBatch rows as
+        they are fetched, without byDate's limit on the number of rows. Each
+        batch is a list of typed rows or, with columnar decoding, a
+        columns.ColumnBatch that can also be iterated as typed rows. Returns
+        a deferred result that fires with the number of rows streamed.
+        """
+        beginMJDsecs,endAtMJDsecs = KeyTable.dateRange(interval,endAt)
+        # copy buffered rows now so that rows flushed during the query are not lost
+        buffer = self.rowBuffer
+        begin,end = buffer.between(beginMJDsecs,endAtMJDsecs)
+        if KeyTable.columnar:
+            layout = self.columnLayout
+            cacheCopy = columns.bufferedBatch(buffer,begin,end)
+        else:
+            layout = None
+            cacheCopy = [ buffer.row(index) for index in range(begin,end) ]
+        if len(buffer) > 0 and buffer.tai[0] < beginMJDsecs:
+            # the buffered rows fully cover the date range
+            result = defer.succeed(0)
+        else:
+            sql = self.selector
+            if len(buffer) > 0:
+                sql += self.noDuplicates % buffer.rawID[0]
+            sql += self.selectAfter % beginMJDsecs
+            if endAt != 'now':
+                sql += self.selectBefore % endAtMJDsecs
+            sql += self.selectInOrder
+            result = Table.connectionPool.runInteraction(keyTableStream,
+                sql,self.columnFinalTypes,consumer,KeyTable.streamBatch,layout)
+        return result.addCallback(self.streamBuffered,cacheCopy,consumer)
+
+    def streamBuffered(self,nRows,cacheCopy,consumer):
+        """
+        Streams rows copied from our buffer after nRows streamed from the database
+        """
+        if isinstance(cacheCopy,columns.ColumnBatch):
+            # the buffer is already bounded in size so stream its rows in one batch
+            if len(cacheCopy):
+                consumer(cacheCopy)
+        else:
+            for index in range(0,len(cacheCopy),KeyTable.streamBatch):
+                consumer(cacheCopy[index:index+KeyTable.streamBatch])
+        return nRows + len(cacheCopy)
+
+    def settledEdge(self,beginMJDsecs,endAtMJDsecs):
+        """
+        Returns the end of the settled chunks within a date range or None
+
+        Rows before the returned chunk boundary are all stored in the database
+        and can no longer change, so they can be served from the query cache.
+        """
+        queryCache = KeyTable.queryCache
+        if queryCache is None or not queryCache.budget or not Table.connectionPool:
+            return None
+        # stop before any of our rows, or the raw rows they join, that are still
+        # on their way to the database
+        settled = KeyTable.clock() - KeyTable.settleDelay
+        for table in (self,Table.registry.get('reply_raw')):
+            since = table.unloadedSince() if table else None
+            if since is not None:
+                settled = min(settled,since)
+        width = queryCache.chunkSeconds
+        edge = (min(endAtMJDsecs,settled)//width)*width
+        return edge if edge > beginMJDsecs else None
+
+    def addChunks(self,rows,beginMJDsecs,chunkEnd):
+        """
+        Appends rows from the settled chunks before chunkEnd, most recent first
+
+        Chunks missing from the query cache are fetched and cached first. Each
+        fetch is limited to the rows still needed, so only the chunks it returns
+        completely are cached.
+        """
+        queryCache = KeyTable.queryCache
+        width = queryCache.chunkSeconds
+        while len(rows) < 1000 and chunkEnd > beginMJDsecs:
+            chunk = queryCache.get((self.name,chunkEnd))
+            if chunk is None:
+                # fetch this chunk and any adjacent missing chunks with one query
+                fetchBegin = chunkEnd - width
+                while (fetchBegin > beginMJDsecs and
+                    chunkEnd - fetchBegin < queryCache.maxFetch*width and
+                    (self.name,fetchBegin) not in queryCache):
+                    fetchBegin -= width
+                # fetch one extra row to detect a fetch cut short by the limit
+                needed = 1000 - len(rows)
+                sql = (self.selector + self.selectAfter % fetchBegin +
+                    self.selectBefore % chunkEnd + self.selectByTime % (needed+1))
+                return Table.connectionPool.runInteraction(
+                    keyTableFetchChunks,sql,self.columnFinalTypes).addCallbacks(
+                    self.gotChunks,self.chunksFailed,
+                    callbackArgs=(rows,beginMJDsecs,fetchBegin,chunkEnd,needed),
+                    errbackArgs=(rows,))
+            for tai,row in chunk:
+                if tai <= beginMJDsecs or len(rows) >= 1000:
+                    break
+                rows.append(row)
+            chunkEnd -= width
+        return rows
+
+    def gotChunks(self,fetched,rows,beginMJDsecs,fetchBegin,fetchEnd,needed):
+        """
+        Caches newly fetched chunks and adds their rows then continues with earlier chunks
+
+        When the fetch was cut short by its limit, the chunk holding its oldest
+        row is incomplete and neither it nor any earlier chunk is cached.
+        """
+        queryCache = KeyTable.queryCache
+        width = queryCache.chunkSeconds
+        if len(fetched) > needed:
+            fetched = fetched[:needed]
+            fetchBegin = fetched[-1][0]
+        chunkEnd,chunk,nBytes = fetchEnd,[ ],0
+        for tai,row in fetched + [ (fetchBegin,None) ]:
+            while tai <= chunkEnd - width:
+                queryCache.put((self.name,chunkEnd),chunk,nBytes)
+                chunkEnd,chunk,nBytes = chunkEnd - width,[ ],0
+            if row is None:
+                break
+            chunk.append((tai,row))
+            nBytes += cache.rowBytes(row)
+            if tai > beginMJDsecs and len(rows) < 1000:
+                rows.append(row)
+        if len(rows) >= 1000:
+            return rows
+        return self.addChunks(rows,beginMJDsecs,fetchBegin)
+
+    def chunksFailed(self,failure,rows):
+        """
+        Returns the rows collected so far after failing to fetch chunks
+        """
+        log.err(failure,'%s: unable to fetch settled rows' % self.name)
+        return rows
+
+    @staticmethod
+    def mergeByDate(keyTables,interval,endAt,consumer):
+        """
+        Streams the rows of several key tables within a date range as one TAI-ordered stream
+
+        Batches of at most streamBatch (keytag,row) pairs are passed to consumer
+        as they are merged. Returns a deferred result that fires with the number
+        of rows streamed.
+        """
+        beginMJDsecs,endMJDsecs = KeyTable.dateRange(interval,endAt)
+        queries = [ ]
+        for keyTable in keyTables:
+            queries.append(keyTable.mergeQuery(beginMJDsecs,endMJDsecs))
+        return Table.connectionPool.runInteraction(
+            keyTablesMerge,queries,consumer,KeyTable.streamBatch)
+
+    def mergeQuery(self,beginMJDsecs,endMJDsecs):
+        """
+        Returns the (keytag,sql,vtypes,buffered) used to merge our rows within a date range
+        """
+        # copy buffered rows now so that rows flushed during the query are not lost
+        buffer = self.rowBuffer
+        begin,end = buffer.between(beginMJDsecs,endMJDsecs)
+        buffered = [ (buffer.tai[index],buffer.rawID[index],buffer.row(index))
+            for index in range(begin,end) ]
+        sql = self.pageSelector
+        if len(buffer) > 0:
+            sql += self.noDuplicates % buffer.rawID[0]
+        sql += self.selectAfter % beginMJDsecs + self.selectBefore % endMJDsecs
+        sql += self.selectTimeOrder
+        return self.tag,sql,self.columnFinalTypes,buffered
+
+    def page(self,interval,endAt,token=None,pageSize=1000,ascending=False):
+        """
+        Returns a page of rows within a date range and a token for the next page
+
+        Pages are most recent first unless ascending is set. Pass the returned
+        token, which is None after the last page, instead of interval and endAt to
+        fetch the next page. Pages continue after the raw ID of the last row
+        returned (keyset pagination), so every page costs the same however deep
+        into the date range it is. Raises DatabaseException for an invalid token.
+        """
+        if token:
+            beginMJDsecs,endMJDsecs,bound,ascending = decodePageToken(token)
+        else:
+            beginMJDsecs,endMJDsecs = KeyTable.dateRange(interval,endAt)
+            bound = None
+        return self.pageByDate(beginMJDsecs,endMJDsecs,bound,ascending,pageSize+1).addCallback(
+            pageResult,beginMJDsecs,endMJDsecs,ascending,pageSize)
+
+    def pageByDate(self,beginMJDsecs,endMJDsecs,bound,ascending,limit):
+        """
+        Returns up to limit (rawID,row) pairs within a date range ordered by raw ID
+
+        Only rows after bound, in the requested order, are returned unless bound is None.
+        """
+        # copy matching buffered rows, which always have the largest raw IDs
+        buffer = self.rowBuffer
+        first,last = buffer.between(beginMJDsecs,endMJDsecs)
+        if bound is not None:
+            if ascending:
+                first = max(first,bisect.bisect_right(buffer.rawID,bound))
+            else:
+                last = min(last,bisect.bisect_left(buffer.rawID,bound))
+        order = range(first,last) if ascending else range(last-1,first-1,-1)
+        cacheCopy = [ (buffer.rawID[index],buffer.row(index))
+            for index in itertools.islice(order,limit) ]
+        if not ascending and len(cacheCopy) == limit:
+            return defer.succeed(cacheCopy)
+        if not Table.connectionPool or (len(buffer) > 0 and buffer.tai[0] < beginMJDsecs):
+            # there is no database or the buffered rows fully cover the date range
+            return defer.succeed(cacheCopy)
+        # use the database for the rows before our buffer
+        sql = self.pageSelector
+        if len(buffer) > 0:
+            sql += self.noDuplicates % buffer.rawID[0]
+        sql += self.selectAfter % beginMJDsecs + self.selectBefore % endMJDsecs
+        if ascending:
+            if bound is not None:
+                sql += self.pageAfter % bound
+            sql += self.pageAscending % limit
+            return Table.connectionPool.runInteraction(
+                keyTablePage,sql,self.columnFinalTypes).addCallback(
+                lambda pairs: pairs + cacheCopy[:limit-len(pairs)])
+        if bound is not None:
+            sql += self.noDuplicates % bound
+        sql += self.selectLimit % (limit-len(cacheCopy))
+        return Table.connectionPool.runInteraction(
+            keyTablePage,sql,self.columnFinalTypes).addCallback(
+            lambda pairs: cacheCopy + pairs)
+
+    def reduceByDate(self,column,beginMJDsecs,endAtMJDsecs,reducer):
+        """
+        Streams the values of one numeric column within a date range into a reducer
+
+        The column indexes our value columns, so 0 is the column after raw_id.
+        Points are added to a decimate.BucketReducer as (TAI MJD secs,value) and
+        the reducer is returned as a Deferred.
+        """
+        buffer = self.rowBuffer
+        if buffer.text[column] is not None:
+            raise DatabaseException('Cannot plot text column %s of %s' %
+                (self.aliases[column+1],self.name))
+        # add any matching rows from our buffer
+        values,nulls = buffer.columns[column],buffer.nulls[column]
+        begin,end = buffer.between(beginMJDsecs,endAtMJDsecs)
+        for index in range(begin,end):
+            if nulls is None or not nulls[index]:
+                reducer.add(buffer.tai[index],values[index])
+        if not Table.connectionPool:
+            return defer.succeed(reducer)
+        sql = self.columnSelector % self.columnNames[column+1]
+        # avoid duplicates in case the buffer is flushed before our db query runs
+        if len(buffer) > 0:
+            sql += self.noDuplicates % buffer.rawID[0]
+        sql += self.selectAfter % beginMJDsecs
+        sql += self.selectBefore % endAtMJDsecs
+        return Table.connectionPool.runInteraction(keyTableReduce,sql,reducer)
+
+    def chooseRollup(self,interval,beginMJDsecs):
+        """
+        Returns the rollup to use for a byDate query or None to use our rows
+
+        A rollup is only used when it covers the whole query, so history from
+        before rollups were enabled is still browsed using our rows.
+        """
+        # will our rows fit within the query limit anyway?
+        if not self.rollups or (self.rowRate is not None and interval*self.rowRate <= 1000):
+            return None
+        for rollup in reversed(self.rollups):
+            if (interval >= KeyTable.rollupPoints*rollup.width and
+                rollup.since is not None and rollup.since <= beginMJDsecs):
+                return rollup
+        return None
+
     def recent(self,nRows):
         """
         Returns the most recent rows added to this key table as a Deferred
         """
         # copy (and reverse) any recent rows currently cached in memory
-        cacheCopy = [ ]
-        for cachedRow in self.rowBuffer[-1:-1-nRows:-1]:
-            cacheCopy.append(list(cachedRow))
-            # replace rawIDs with timestamps
-            cacheCopy[-1][0] = self.taiCache[cacheCopy[-1][0]]
+        buffer = self.rowBuffer
+        cacheCopy = [ buffer.row(index)
+            for index in range(len(buffer)-1,max(len(buffer)-1-nRows,-1),-1) ]
         # does the cache contain all the recent rows requested?
         if len(cacheCopy) == nRows or not Table.connectionPool:
             return defer.succeed(cacheCopy)
         # we still need to retrieve some rows from the database
         sql = self.selector
         # avoid duplicates in case the cache is flushed before our db query runs
-        if len(self.rowBuffer) > 0:
-            sql += self.noDuplicates % self.rowBuffer[0][0]
+        if len(buffer) > 0:
+            sql += self.noDuplicates % buffer.rawID[0]
         sql += self.selectLimit % (nRows-len(cacheCopy))
         return Table.connectionPool.runInteraction(
             keyTableFetch,sql,self.columnFinalTypes,cacheCopy)
     
     def openBuffer(self):
         """
-        Creates an empty rawID-TAI map
+        Creates an empty columnar row buffer
+        """
+        Table.openBuffer(self)
+        try:
+            layout = self.columnLayout
+        except AttributeError:
+            # the first column holds the rawID, which the buffer stores separately
+            layout = self.columnLayout = columns.ColumnLayout(self.columnFinalTypes[1:])
+        self.rowBuffer = columns.ColumnBuffer(layout)
+
+    def bufferedSince(self):
+        """
+        Returns the TAI of the oldest row in our current buffer or None
         """
-        self.taiCache = { }
-        return Table.openBuffer(self)
+        return self.rowBuffer.tai[0] if len(self.rowBuffer) > 0 else None
         
     def record(self,tai,rawID,*rowValues):
         """
-        Remembers the timestamp associated with a raw ID
+        Records a row of values for a raw ID timestamped in TAI MJD seconds
         """
-        self.taiCache[rawID] = tai
-        return Table.record(self,rawID,*rowValues)
-    
+        self.recordEncodedRow(tai,self.encodeRow((rawID,)+rowValues),rawID,*rowValues)
+
+    def recordEncodedRow(self,tai,encoded,rawID,*rowValues):
+        """
+        Records a row that has already been encoded by encodeRow
+        """
+        # buffer the values first so that a value the columns cannot store is not written
+        self.rowBuffer.append(tai,rawID,rowValues)
+        self.bufferFile.write(encoded)
+        self.rowAdded()
+
+    def rollUp(self,tai,rawID,values):
+        """
+        Adds a row of values to our rollups
+
+        This is called for every valid row received, before any storage policy
+        decides whether to record it, so that rollups summarize every value.
+        """
+        for rollup in self.rollups:
+            rollup.add(tai,rawID,values)
+
+class Rollup(object):
+    """
+    Maintains per-bucket statistics of a numeric keyword in its own table
+
+    Each row summarizes the values recorded in one bucket of TAI time with the
+    count of rows and the min, max, mean and last of each value column. A
+    bucket's row is recorded, with the raw ID of its last row as its primary key,
+    once a later bucket is started or the server shuts down. When the server
+    restarts within a bucket, the bucket's stored row is merged into the new
+    row for that bucket and deleted. Rollups are not backfilled, so each one
+    records the time from which its buckets are complete.
+    """
+    # the (width in seconds,label) of each rollup to maintain, from finest to coarsest
+    widths = [ ]
+    units = { 's': 1, 'm': 60, 'h': 3600, 'd': 86400 }
+
+    stats = ('min','max','mean','last')
+
+    # every rollup, so that their open buckets can be recorded at shutdown
+    registry = [ ]
+
+    @staticmethod
+    def forTable(keyTable):
+        """
+        Returns the rollups to maintain for a key table, from finest to coarsest
+
+        Only keywords whose values are all plain numbers are rolled up.
+        """
+        # a table that is attached again keeps its rollups
+        if 'rollups' in keyTable.__dict__:
+            return keyTable.rollups
+        for vtype in keyTable.columnFinalTypes[1:]:
+            if (vtype.storage.lower()[:3] not in ('int','flt') or
+                hasattr(vtype,'storageValue')):
+                return ( )
+        return tuple(Rollup(keyTable,width,label) for width,label in Rollup.widths)
+
+    @staticmethod
+    def closeAll():
+        """
+        Records the open bucket of every rollup
+        """
+        for rollup in Rollup.registry:
+            rollup.close()
+
+    def __init__(self,keyTable,width,label):
+        self.width = width
+        self.nValues = len(keyTable.columnNames)-1
+        columnTypes = [ types.Long(name='raw_id'),types.Double(name='bucket'),
+            types.Long(name='nrows') ]
+        for colName in keyTable.columnNames[1:]:
+            for stat in Rollup.stats:
+                columnTypes.append(types.Double(name='%s_%s' % (colName,stat)))
+        name = '%s__%s' % (keyTable.name,label)
+        existing = name in Table.existing
+        self.table = Table.attach(name,tuple(columnTypes),
+            bufferSize=KeyTable.bufferSize,indices=('bucket',))
+        # queries return the bucket and the mean of each value
+        self.vtypes = [ types.Double(name='mean') ]*(1+self.nValues)
+        self.means = [ 3+len(Rollup.stats)*index+2 for index in range(self.nValues) ]
+        names = self.table.columnNames
+        self.selector = 'select %s' % names[1]
+        for index in self.means:
+            self.selector += ',%s' % names[index]
+        self.selector += ' from %s where %s > %%r' % (self.table.name,names[1])
+        self.selectBefore = ' and %s <= %%r' % names[1]
+        self.noDuplicates = ' and %s < %%ld' % names[0]
+        self.selectLimit = ' order by %s desc limit %%d;' % names[0]
+        self.bucket = None
+        # the start of our first complete bucket, once known
+        self.since = None
+        # the stored row of the bucket that was open when the server last stopped
+        self.resume = None
+        if existing and Table.connectionPool:
+            sql = ('select (select min(%s) from %s),* from %s order by %s desc limit 1;' %
+                (names[1],self.table.name,self.table.name,names[1]))
+            Table.connectionPool.runInteraction(rollupState,sql).addCallbacks(
+                self.gotState,log.err)
+        Rollup.registry.append(self)
+
+    def gotState(self,state):
+        """
+        Resumes from the first and last buckets stored before the server restarted
+        """
+        if state is None:
+            return
+        first,last = state[0],list(state[1:])
+        # the first stored bucket may only be partly filled
+        self.since = first + self.width
+        if self.bucket is None or self.bucket == last[1]:
+            self.resume = last
+            if self.bucket is not None:
+                self.merge()
+
+    def merge(self):
+        """
+        Merges the stored row of our open bucket into it and deletes the stored row
+        """
+        row,self.resume = self.resume,None
+        nRows = int(row[2])
+        self.nRows += nRows
+        for index in range(self.nValues):
+            low,high,mean,last = row[3+len(Rollup.stats)*index:3+len(Rollup.stats)*(index+1)]
+            if mean is None:
+                continue
+            if self.counts[index]:
+                self.mins[index] = min(self.mins[index],low)
+                self.maxs[index] = max(self.maxs[index],high)
+            else:
+                self.mins[index],self.maxs[index],self.lasts[index] = low,high,last
+            # stored means do not record how many values were valid so assume all were
+            self.counts[index] += nRows
+            self.sums[index] += mean*nRows
+        Table.connectionPool.runInteraction(executeSQL,[ 'delete from %s where %s=%d' % (
+            self.table.name,self.table.columnNames[0],row[0]) ],self).addErrback(log.err)
+
+    def add(self,tai,rawID,rowValues):
+        """
+        Adds a row of values timestamped in TAI MJD seconds to its bucket
+        """
+        bucket = tai - tai % self.width
+        if bucket != self.bucket:
+            self.close()
+            if self.since is None:
+                # our first bucket may only be partly filled
+                self.since = bucket + self.width
+            self.bucket = bucket
+            self.nRows = 0
+            self.counts = [ 0 ]*self.nValues
+            self.mins = [ None ]*self.nValues
+            self.maxs = [ None ]*self.nValues
+            self.sums = [ 0. ]*self.nValues
+            self.lasts = [ None ]*self.nValues
+            if self.resume is not None:
+                if self.resume[1] == bucket:
+                    self.merge()
+                else:
+                    self.resume = None
+        self.lastRawID = rawID
+        self.nRows += 1
+        for index,value in enumerate(rowValues[:self.nValues]):
+            if value is types.InvalidValue:
+                continue
+            value = float(value)
+            if self.counts[index]:
+                self.mins[index] = min(self.mins[index],value)
+                self.maxs[index] = max(self.maxs[index],value)
+            else:
+                self.mins[index] = self.maxs[index] = value
+            self.counts[index] += 1
+            self.sums[index] += value
+            self.lasts[index] = value
+
+    def summary(self):
+        """
+        Returns the table row that summarizes our open bucket
+        """
+        row = [ self.lastRawID,self.bucket,self.nRows ]
+        for index,count in enumerate(self.counts):
+            if count:
+                row.extend((self.mins[index],self.maxs[index],
+                    self.sums[index]/count,self.lasts[index]))
+            else:
+                row.extend((types.InvalidValue,)*len(Rollup.stats))
+        return row
+
+    def close(self):
+        """
+        Records our open bucket, if any
+        """
+        if self.bucket is None:
+            return
+        self.table.record(*self.summary())
+        self.bucket = None
+
+    def byDate(self,beginMJDsecs,endAtMJDsecs,toNow):
+        """
+        Returns the bucket start times and mean values within a date range
+        """
+        # copy the open bucket and any buffered buckets, most recent first
+        cacheCopy = [ ]
+        buffered = list(self.table.rowBuffer)
+        if self.bucket is not None:
+            buffered.append(self.summary())
+        for row in buffered[::-1]:
+            if beginMJDsecs < row[1] <= endAtMJDsecs:
+                cacheCopy.append([ columns.taiTimestamp(row[1]) ] +
+                    [ row[index] for index in self.means ])
+        if not Table.connectionPool:
+            return defer.succeed(cacheCopy)
+        sql = self.selector % beginMJDsecs
+        if not toNow:
+            sql += self.selectBefore % endAtMJDsecs
+        # avoid duplicates in case the buffer is flushed before our db query runs
+        if len(self.table.rowBuffer) > 0:
+            sql += self.noDuplicates % self.table.rowBuffer[0][0]
+        sql += self.selectLimit % max(0,1000-len(cacheCopy))
+        return Table.connectionPool.runInteraction(
+            keyTableFetch,sql,self.vtypes,cacheCopy)
@@ -0,0 +1,109 @@
+"""
+Reduces a series of (x,y) points to a small number of points for plotting
+"""
+
+infinities = (float('inf'),float('-inf'))
+
+class BucketReducer(object):
+    """
+    Keeps the minimum and maximum y point within each of nBuckets equal x ranges
+
+    Points can be added in any order, one at a time, so that a series of any
+    length can be reduced using memory proportional to nBuckets. Points outside
+    of [begin,end] are ignored, as are missing, NaN and infinite y values, which
+    cannot be compared or written as JSON.
+    """
+    def __init__(self,begin,end,nBuckets):
+        if nBuckets < 1:
+            raise ValueError('need at least one bucket')
+        self.begin = begin
+        self.end = end
+        self.nBuckets = nBuckets
+        self.scale = nBuckets/float(end - begin) if end > begin else 0.
+        self.lows = [ None ]*nBuckets
+        self.highs = [ None ]*nBuckets
+        self.nPoints = 0
+
+    def add(self,x,y):
+        """
+        Adds one point to its bucket
+        """
+        if y is None or y != y or y in infinities or not self.begin <= x <= self.end:
+            return
+        self.nPoints += 1
+        index = min(int((x - self.begin)*self.scale),self.nBuckets-1)
+        low = self.lows[index]
+        if low is None:
+            self.lows[index] = self.highs[index] = (x,y)
+        elif y < low[1]:
+            self.lows[index] = (x,y)
+        elif y > self.highs[index][1]:
+            self.highs[index] = (x,y)
+
+    def points(self):
+        """
+        Returns the minimum and maximum points of each bucket in x order
+        """
+        points = [ ]
+        for low,high in zip(self.lows,self.highs):
+            if low is None:
+                continue
+            if low is high:
+                points.append(low)
+            elif low[0] <= high[0]:
+                points.extend((low,high))
+            else:
+                points.extend((high,low))
+        return points
+
+def minmax(points,nBuckets):
+    """
+    Returns the minimum and maximum of each of nBuckets equal x ranges of points
+
+    The points must be sorted in x.
+    """
+    if not points:
+        return [ ]
+    reducer = BucketReducer(points[0][0],points[-1][0],nBuckets)
+    for x,y in points:
+        reducer.add(x,y)
+    return reducer.points()
+
+def lttb(points,threshold):
+    """
+    Returns threshold points selected using Largest-Triangle-Three-Buckets
+
+    The points must be sorted in x. The first and last points are always
+    selected, and each bucket in between contributes the point that forms the
+    largest triangle with the previously selected point and the average of
+    the next bucket.
+    """
+    nPoints = len(points)
+    if threshold >= nPoints or threshold < 3:
+        return list(points)
+    selected = [ points[0] ]
+    every = (nPoints - 2)/float(threshold - 2)
+    last = 0
+    for bucket in range(threshold - 2):
+        # average the points in the next bucket
+        avgBegin = int((bucket + 1)*every) + 1
+        avgEnd = min(int((bucket + 2)*every) + 1,nPoints)
+        avgX = avgY = 0.
+        for x,y in points[avgBegin:avgEnd]:
+            avgX += x
+            avgY += y
+        avgX /= (avgEnd - avgBegin)
+        avgY /= (avgEnd - avgBegin)
+        # select the point in this bucket with the largest triangle area
+        lastX,lastY = points[last]
+        maxArea = -1.
+        for index in range(int(bucket*every) + 1,int((bucket + 1)*every) + 1):
+            x,y = points[index]
+            area = abs((lastX - avgX)*(y - lastY) - (lastX - x)*(avgY - lastY))
+            if area > maxArea:
+                maxArea = area
+                chosen = index
+        selected.append(points[chosen])
+        last = chosen
+    selected.append(points[-1])
+    return selected
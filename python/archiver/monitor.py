@@ -14,8 +14,10 @@ from archiver import expression,database,actors
 from opscore.protocols import keys
 
 from twisted.internet import defer
+from twisted.python import log
 
 import time
+import heapq,itertools
 
 class MonitorError(Exception):
     pass
@@ -23,16 +25,24 @@ class MonitorError(Exception):
 lines = { }
 subscriptions = { }
 subscribers = { }
+# the expressions that watch each lower-case actor.keyword
+watchers = { }
+# cleared when keywords are recorded by worker processes that never dispatch to us
+enabled = True
 
 def create(name,expr,help=None):
     """
     Creates a new keyword expression to monitor
     """
+    if not enabled:
+        raise MonitorError('Monitoring is not available with --shards')
     lcname = name.lower()
     if lcname in lines:
         raise MonitorError('Name already in use: %s' % name)
-    lines[lcname] = MonitorExpression(name,expr,help)
+    monitorExpr = lines[lcname] = MonitorExpression(name,expr,help)
     subscriptions[lcname] = [ ]
+    for keytag in monitorExpr.parsed.watchSet:
+        watchers.setdefault(keytag,[ ]).append(monitorExpr)
     
 def lineInfo():
     """
@@ -64,12 +74,40 @@ def drop(name):
         raise MonitorError('No such monitor: %s' % name)
     if subscriptions[lcname]:
         raise MonitorError('Cannot drop monitor with subscribers')        
-    del lines[lcname]
+    monitorExpr = lines.pop(lcname)
+    for keytag in monitorExpr.parsed.watchSet:
+        watchers[keytag].remove(monitorExpr)
+        if not watchers[keytag]:
+            del watchers[keytag]
+    
+def dispatch(keytag,timestamp,values):
+    """
+    Updates the expressions that watch a lower-case actor.keyword with new values
+
+    This is called for every keyword recorded so it only costs a dictionary
+    lookup for keywords that are not being watched. Each affected expression is
+    updated once and its new value is passed to all of its subscribers.
+    """
+    watching = watchers.get(keytag)
+    if not watching:
+        return
+    for monitorExpr in watching:
+        try:
+            changed = monitorExpr.update(keytag,values)
+        except Exception:
+            log.err(None,'Unable to update monitor %s with %s' % (monitorExpr.name,keytag))
+            continue
+        if changed:
+            for sub in list(subscriptions[monitorExpr.name.lower()]):
+                if not sub.expired():
+                    sub.append(timestamp)
     
 def subscribe(name,timeout=None,history=None):
     """
     Subscribes to the named expression
     """
+    if not enabled:
+        raise MonitorError('Monitoring is not available with --shards')
     lcname = name.lower()
     if not lcname in lines:
         raise MonitorError('No such monitor to subscribe to: %s' % name)
@@ -101,32 +139,80 @@ class MonitorSubscription(object):
         self.buffer = [ ]
         self.lastFlush = time.time()
         self.id = '%08x' % id(self)
+        self.waiting = False
         if history:
+            # replay history on a private copy of the expression so that the
+            # shared live state is untouched, and hold back live updates until
+            # the replay has caught up with them
             self.waiting = True
-            self.monitorExpr.loadByDate(history,'now').addCallback(self.gotHistory)
+            self.pending = [ ]
+            self.replay = MonitorExpression(monitorExpr.name,monitorExpr.expr,monitorExpr.help)
+            self.replay.loadByDate(history,'now').addCallbacks(
+                self.gotHistory,self.historyFailed)
         
-    def gotHistory(self,history):
+    def gotHistory(self,page):
+        history,token = page
         print('=== gotHistory','='*20)
-        print(repr(history))
+        print('%d updates' % len(history))
         for (keytag,timestamp,values) in history:
             self.update(keytag,timestamp,values)
+        if token:
+            # continue with the next page of history
+            self.replay.loadByDate(None,None,token).addCallbacks(
+                self.gotHistory,self.historyFailed)
+        else:
+            self.caughtUp()
+
+    def historyFailed(self,failure):
+        log.err(failure,'Unable to load history for subscription ID %s' % self.id)
+        self.caughtUp()
+
+    def caughtUp(self):
+        """
+        Releases the live updates held back while history was replayed
+        """
+        # skip any live updates that the replay has already covered
+        last = self.buffer[-1][0] if self.buffer else None
+        for timestamp,value in self.pending:
+            if last is None or timestamp > last:
+                self.buffer.append((timestamp,value))
         self.waiting = False
+        self.pending = self.replay = None
 
     def update(self,keytag,timestamp,values):
         """
-        Updates this subscription to reflect new keyword values
+        Updates our private copy of the expression with historical keyword values
         """
-        if time.time() - self.lastFlush < self.timeout:
-            if self.monitorExpr.update(keytag,values):
-                value = self.monitorExpr.value()
-                if value is not None:
-                    self.buffer.append((timestamp,value))
+        if not self.expired() and self.replay.update(keytag,values):
+            value = self.replay.value()
+            if value is not None:
+                self.buffer.append((timestamp,value))
+
+    def append(self,timestamp):
+        """
+        Buffers the current value of our expression, if any
+        """
+        value = self.monitorExpr.value()
+        if value is None:
+            return
+        if self.waiting:
+            self.pending.append((timestamp,value))
         else:
+            self.buffer.append((timestamp,value))
+
+    def expired(self):
+        """
+        Returns True, after cancelling this subscription, once it has timed out
+        """
+        if time.time() - self.lastFlush < self.timeout:
+            return False
+        if self.id in subscribers:
             # subscription has expired: no more updates will be accepted
-            lcname = sef.monitorExpr.name.lower()
-            sublist = subscriptions[lcname].remove(self)
-            del subscribers[sub.id]
-            log.msg('Expired subscription ID %s' % sub.id)
+            lcname = self.monitorExpr.name.lower()
+            subscriptions[lcname].remove(self)
+            del subscribers[self.id]
+            log.msg('Expired subscription ID %s' % self.id)
+        return True
 
     def flush(self):
         """
@@ -192,28 +278,53 @@ class MonitorExpression(object):
             raise MonitorError('Invalid keyword value in %s' % node)
         node.valueItem = foundIndex
         
-    def mergeTables(self,results):
-        updates = { }
+    # history is loaded in pages of at most this many updates
+    historyPage = 1000
+
+    def mergeTables(self,results,beginMJDsecs,endMJDsecs):
+        pages = [ ]
         for (success,tableData),table in zip(results,self.tables):
             if not success:
                 raise MonitorError('Unable to load data for %s' % table.tag)
             print('processing %d rows from %s' % (len(tableData),table.tag))
-            for row in tableData:
-                timestamp,values = row[0],row[1:]
-                tai = timestamp.MJD()*86400.
-                updates[tai] = (table.tag,tai,values)
-        # merge the updates with a master sort on TAI
-        return [ updates[t] for t in sorted(updates) ]
-
-    def loadByDate(self,interval,endAt):
+            pages.append(self.tableUpdates(table.tag,tableData))
+        # merge the updates in the order they were received, which is also their TAI
+        # order, stopping once we know whether there is another page
+        updates = list(itertools.islice(heapq.merge(*pages),self.historyPage+1))
+        return database.pageResult(
+            updates,beginMJDsecs,endMJDsecs,True,self.historyPage)
+
+    def tableUpdates(self,keytag,tableData):
+        """
+        Yields the (rawID,update) pairs for a page of rows from one table
+        """
+        for rawID,row in tableData:
+            timestamp,values = row[0],row[1:]
+            yield rawID,(keytag,timestamp.MJD()*86400.,values)
+
+    def loadByDate(self,interval,endAt,token=None):
+        """
+        Returns a page of updates, oldest first, and a token for the next page
+
+        Pass the returned token, which is None after the last page, instead of
+        interval and endAt to load the next page.
+        """
+        if token:
+            beginMJDsecs,endMJDsecs,bound,ascending = database.decodePageToken(token)
+        else:
+            beginMJDsecs,endMJDsecs = database.KeyTable.dateRange(interval,endAt)
+            bound = None
+        # the first historyPage+1 updates of the merged page can only come from
+        # the first historyPage+1 rows of each table
         defers = [ ]
         for table in self.tables:
-            defers.append(table.byDate(interval,endAt))
-        return defer.DeferredList(defers).addCallback(self.mergeTables)
+            defers.append(table.pageByDate(
+                beginMJDsecs,endMJDsecs,bound,True,self.historyPage+1))
+        return defer.DeferredList(defers).addCallback(
+            self.mergeTables,beginMJDsecs,endMJDsecs)
         
     def value(self):
         return self.parsed.value
         
     def update(self,keytag,values):
-        # could implement cacheing here to optimize multiple suscribers
         return self.parsed.update(keytag,values)
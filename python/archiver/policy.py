@@ -0,0 +1,149 @@
+"""
+Storage policies that decide which validated keyword values are recorded
+
+Policies are configured with a list of rules such as:
+
+    tcc.*=onchange mcp.aliveAt=every:60 xcu_b1.temps=deadband:0.1 tcc.axePos=deadband:1%
+
+where a rule for a specific keyword takes precedence over a rule for all of an
+actor's keywords (actor.*). Keywords without a rule are always recorded.
+Suppressed values are still available from their raw message in reply_raw.
+"""
+
+import re
+import numbers
+
+class PolicyError(Exception):
+    pass
+
+class Policy(object):
+    """
+    Records every value of a keyword
+    """
+    # statistics for all keywords
+    stored = 0
+    suppressed = 0
+
+    def __init__(self):
+        self.lastValues = None
+        self.lastStored = None
+        self.nSuppressed = 0
+
+    def accept(self,tai,values):
+        """
+        Returns True if values timestamped at tai (MJD seconds) should be recorded
+        """
+        if self.lastStored is None or self.changed(tai,values):
+            self.lastValues = values
+            self.lastStored = tai
+            Policy.stored += 1
+            return True
+        self.nSuppressed += 1
+        Policy.suppressed += 1
+        return False
+
+    def changed(self,tai,values):
+        return True
+
+class OnChange(Policy):
+    """
+    Records a keyword's values whenever they change
+    """
+    def changed(self,tai,values):
+        return values != self.lastValues
+
+class Deadband(Policy):
+    """
+    Records a keyword's values when any numeric value changes by more than a deadband
+
+    The deadband is absolute, or relative to the last recorded value when it is
+    given as a percentage. Non-numeric values are recorded whenever they change.
+    """
+    def __init__(self,band):
+        Policy.__init__(self)
+        if band.endswith('%'):
+            # accept %% as written in a config file that uses % interpolation
+            self.band,self.relative = float(band.rstrip('%'))/100.,True
+        else:
+            self.band,self.relative = float(band),False
+        if self.band < 0:
+            raise ValueError('deadband must not be negative')
+
+    def changed(self,tai,values):
+        if len(values) != len(self.lastValues):
+            return True
+        for value,last in zip(values,self.lastValues):
+            if (isinstance(value,numbers.Real) and isinstance(last,numbers.Real)
+                and not isinstance(value,bool)):
+                band = self.band*abs(last) if self.relative else self.band
+                if abs(value - last) > band:
+                    return True
+            elif value != last:
+                return True
+        return False
+
+class Every(Policy):
+    """
+    Records a keyword's values at most once every interval seconds
+    """
+    def __init__(self,interval):
+        Policy.__init__(self)
+        self.interval = float(interval)
+
+    def changed(self,tai,values):
+        return tai - self.lastStored >= self.interval
+
+"""
+The policy class and argument, if any, for each named policy
+"""
+policyClasses = {
+    'always': (Policy,False),
+    'onchange': (OnChange,False),
+    'deadband': (Deadband,True),
+    'every': (Every,True)
+}
+
+"""
+The (policy class,arguments) configured for each lower-case keytag or actor.*
+"""
+rules = { }
+
+def init(spec):
+    """
+    Configures policies from a string of actor.keyword=policy[:arg] rules
+    """
+    rules.clear()
+    for rule in re.split(r'[,\s]+',spec or ''):
+        if not rule:
+            continue
+        try:
+            keytag,name = rule.split('=')
+            actorName,keyName = keytag.split('.')
+        except ValueError:
+            raise PolicyError('Invalid storage policy rule: %s' % rule)
+        name,colon,arg = name.partition(':')
+        if name not in policyClasses:
+            raise PolicyError('Unknown storage policy in rule: %s' % rule)
+        policyClass,needsArg = policyClasses[name]
+        args = (arg,) if needsArg else ()
+        if bool(colon) != needsArg:
+            raise PolicyError('Invalid storage policy argument in rule: %s' % rule)
+        try:
+            # check that this rule's arguments are valid
+            policyClass(*args)
+        except ValueError as e:
+            raise PolicyError('Invalid storage policy rule: %s (%s)' % (rule,e))
+        rules[keytag.lower()] = (policyClass,args)
+
+def forKey(actorName,keyName):
+    """
+    Returns a new policy for recording a keyword or None if it should always be recorded
+    """
+    actorName = actorName.lower()
+    rule = rules.get('%s.%s' % (actorName,keyName.lower())) or rules.get(actorName + '.*')
+    if rule is None:
+        return None
+    policyClass,args = rule
+    if policyClass is Policy:
+        return None
+    return policyClass(*args)
@@ -8,14 +8,19 @@ from __future__ import absolute_import
 
 from builtins import str
 from datetime import datetime
+import collections
+import re
+import threading
+import time
+import zlib
 
 import twisted.internet.error
-from twisted.python import log
+from twisted.internet import threads,protocol
+from twisted.python import log,failure,threadpool
 from twisted.protocols.basic import LineOnlyReceiver as Receiver
 
-from opscore.protocols import parser,types,keys,validation
-from opscore.utility import astrotime
-from . import database,actors,monitor
+from opscore.protocols import parser,types,keys,validation,messages
+from . import database,actors,monitor,clock
 
 class MessageReceiver(Receiver):
     
@@ -25,8 +30,10 @@ class MessageReceiver(Receiver):
         self.name = name
         if not self.name:
             self.name = self.__class__.__name__
-        self.messagesReceived = 0
+        self.messageCount = 0
         self.bytesReceived = 0
+        # bytes received after the last complete line
+        self.unframed = b''
         # disable compound value wrapping (eg, PVTs)
         types.CompoundValueType.WrapEnable = False
     
@@ -44,14 +51,41 @@ class MessageReceiver(Receiver):
         self.connectedSince = None
         return Receiver.connectionLost(self,reason)
 
-    def lineReceived(self, message):
-        message = message.decode('latin-1')
-        self.messagesReceived += 1
-        # strip off a trailing \r (this allows us to accept lines via telnet)
-        if message[-1] == '\r':
-            message = message[:-1]
-        self.bytesReceived += len(message)
-        self.messageReceived(message)
+    def dataReceived(self,data):
+        """
+        Splits received data into complete lines and handles them as one batch
+        """
+        data = self.unframed + data
+        end = data.rfind(self.delimiter)
+        if end < 0:
+            self.unframed = data
+            if len(data) > self.MAX_LENGTH:
+                return self.lineLengthExceeded(data)
+            return
+        self.unframed = data[end+1:]
+        # decode all complete lines in one pass
+        text = data[:end].decode('latin-1')
+        # strip off any trailing \r (this allows us to accept lines via telnet)
+        if '\r' in text:
+            text = text.replace('\r\n','\n')
+            if text[-1:] == '\r':
+                text = text[:-1]
+        batch = text.split('\n')
+        if len(text) > self.MAX_LENGTH:
+            for index,message in enumerate(batch):
+                if len(message) > self.MAX_LENGTH:
+                    self.messagesReceived(batch[:index])
+                    return self.lineLengthExceeded(message)
+        self.messageCount += len(batch)
+        self.bytesReceived += len(text) - len(batch) + 1
+        self.messagesReceived(batch)
+
+    def messagesReceived(self,batch):
+        """
+        Handles a batch of messages that arrived together
+        """
+        for message in batch:
+            self.messageReceived(message)
         
     def lineLengthExceeded(self,message):
         print('%s: max line length exceeded: %d > %d' % (
@@ -63,7 +97,7 @@ class MessageReceiver(Receiver):
         if self.connectedSince:
             uptime = datetime.now() - self.connectedSince
             return '%s: recieved %d messages (%d bytes) from %s (connected %s)' % (
-                self.name,self.messagesReceived,self.bytesReceived,
+                self.name,self.messageCount,self.bytesReceived,
                 self.transport.getPeer(),uptime
             )
         else:
@@ -174,66 +208,478 @@ class CommandReceiver(MessageReceiver):
 
 class ReplyReceiver(MessageReceiver):
 
+    # an optional pool of threads that parse, validate and encode replies
+    workers = None
+
+    # the worker processes that replies are forwarded to when sharding
+    shards = [ ]
+
+    # validated keyword values shared by all receivers
+    keywordCache = None
+
+    @staticmethod
+    def startWorkers(nThreads):
+        """
+        Moves reply parsing, validation and encoding off the reactor thread
+        """
+        from twisted.internet import reactor
+        pool = threadpool.ThreadPool(nThreads,nThreads,'ReplyReceiver')
+        reactor.callWhenRunning(pool.start)
+        reactor.addSystemEventTrigger('during','shutdown',pool.stop)
+        ReplyReceiver.workers = pool
+
     def __init__(self):
         MessageReceiver.__init__(self)
-        # initialize a reply message parser
-        self.replyParser = parser.ReplyParser()
         # lookup the core reply tables we will fill
         self.replyRaw = database.Table.attach('reply_raw')
         self.replyHdr = database.Table.attach('reply_hdr')
-        # use UTC for timestamps when the system clock is actually tracking TAI
-        if MessageReceiver.options.systemClock == 'TAI':
-            self.timestampTZ = astrotime.UTC
-        else:
-            self.timestampTZ = astrotime.TAI
+        self.clock = clock.TAIClock(MessageReceiver.options.systemClock)
+        if ReplyReceiver.keywordCache is None:
+            ReplyReceiver.keywordCache = KeywordCache(MessageReceiver.options.keywordCache)
+        # raw IDs of replies being interpreted by our workers, in the order received,
+        # and the results that are waiting for earlier replies to be recorded
+        self.interpreting = collections.deque()
+        self.interpreted = { }
         
+    def messagesReceived(self,batch):
+        # timestamp this batch of messages in TAI MJD seconds
+        tai = self.clock()
+        # flush any tables that fill up once the whole batch has been recorded
+        database.Table.beginBatch()
+        try:
+            for message in batch:
+                self.replyReceived(tai,message)
+        finally:
+            database.Table.endBatch()
+
     def messageReceived(self,message):
-        # timestamp this message in TAI MJD seconds
-        now = astrotime.AstroTime.now(tz=self.timestampTZ)
-        tai = now.MJD()*86400.
+        self.messagesReceived([message])
+
+    def replyReceived(self,tai,message):
+        """
+        Records a raw reply message and then forwards or interprets it
+        """
         # record the raw reply message before trying to interpret it
         rawID = self.replyRaw.nRows
         self.replyRaw.record(rawID,tai,message)
-        # try to parse the reply message
+        if ReplyReceiver.shards:
+            self.forwardReply(rawID,tai,message)
+        else:
+            self.interpretReply(rawID,tai,message)
+
+    def forwardReply(self,rawID,tai,message):
+        """
+        Forwards a reply to the worker process that owns its actor's tables
+        """
+        actorName = replyActor(message)
+        if actorName is None:
+            log.err('%s: unable to parse message: %r' % (self.name,message))
+            return
+        try:
+            actor = actors.Actor.attach(actorName)
+        except actors.ActorException as e:
+            log.err('%s: unable to attach actor: %s' % (self.name,e))
+            return
+        shards = ReplyReceiver.shards
+        shard = shards[zlib.crc32(actorName.encode('latin-1')) % len(shards)]
+        shard.forward(rawID,tai,actor.idnum,message)
+
+    def interpretReply(self,rawID,tai,message):
+        """
+        Interprets a reply using our worker threads, if any, or else right away
+        """
+        if ReplyReceiver.workers:
+            from twisted.internet import reactor
+            self.interpreting.append(rawID)
+            threads.deferToThreadPool(reactor,ReplyReceiver.workers,
+                self.interpret,rawID,message).addBoth(self.gotReply,rawID,tai)
+        else:
+            self.recordReply(rawID,tai,self.interpret(rawID,message))
+
+    def gotReply(self,result,rawID,tai):
+        """
+        Records interpreted replies in the order they were received
+        """
+        self.interpreted[rawID] = (tai,result)
+        database.Table.beginBatch()
+        try:
+            while self.interpreting and self.interpreting[0] in self.interpreted:
+                rawID = self.interpreting.popleft()
+                tai,result = self.interpreted.pop(rawID)
+                self.recordReply(rawID,tai,result)
+        finally:
+            database.Table.endBatch()
+
+    def interpret(self,rawID,message):
+        """
+        Parses a reply message and validates and encodes its keywords
+
+        Returns a tuple (parsed,checked) where checked lists the results of
+        checkKeywords, or is None if this message's actor has not been
+        attached yet. Returns (None,error) if the message cannot be parsed.
+        This can run in a worker thread so it only reads shared state.
+        """
+        # only the header is recorded for actors without a dictionary
+        actor = actors.Actor.registry.get(replyActor(message))
+        if actor is not None and not actor.kdict:
+            summary = replySummary(message)
+            if summary is not None:
+                return (summary,None)
+        try:
+            parsed = replyParser().parse(message)
+        except parser.ParseError as e:
+            return (None,e)
+        actor = actors.Actor.registry.get(parsed.header.actor)
+        if actor is None or not actor.kdict:
+            return (parsed,None)
+        return (parsed,self.checkKeywords(actor,rawID,parsed.keywords))
+
+    def checkKeywords(self,actor,rawID,keywords):
+        """
+        Validates keywords against an actor's dictionary
+
+        Returns a list of (keyword,key,valid,values,encoded) tuples where key is
+        None for an unknown keyword, values are the keyword's typed values and
+        encoded is the keyword's database row, if its table has already been
+        attached. Keywords repeated with identical values are looked up in our
+        keyword cache instead of being validated and encoded again.
+        """
+        cache = ReplyReceiver.keywordCache
+        checked = [ ]
+        for keyword in keywords:
+            try:
+                key = actor.kdict[keyword.name]
+            except KeyError:
+                checked.append((keyword,None,False,None,None))
+                continue
+            cacheKey = (actor.name,keyword.name,tuple(keyword.values))
+            cached = cache.get(cacheKey)
+            if cached is None:
+                if not key.consume(keyword):
+                    checked.append((keyword,key,False,None,None))
+                    continue
+                values,encodedValues = tuple(keyword.values),None
+            else:
+                values,encodedValues = cached
+            encoded = None
+            # KeyTable.attach caches each key's table in the key itself
+            keyTable = getattr(key,'keyTable',None)
+            if keyTable is not None:
+                if encodedValues is None:
+                    encodedValues = keyTable.encodeValues(values)
+                    cached = None
+                encoded = keyTable.encodeRawID(rawID,encodedValues)
+            if cached is None:
+                cache.put(cacheKey,(values,encodedValues))
+            checked.append((keyword,key,True,values,encoded))
+        return checked
+
+    def recordReply(self,rawID,tai,result):
+        """
+        Records an interpreted reply's keywords and header
+
+        Runs on the reactor thread since it attaches actors and tables.
+        """
+        if isinstance(result,failure.Failure):
+            log.err(result,'%s: unable to interpret message' % self.name)
+            return
+        parsed,checked = result
+        if parsed is None:
+            log.err('%s: unable to parse message: %s' % (self.name,checked))
+            return
         try:
-            parsed = self.replyParser.parse(message)
             # lookup this actor
             hdr = parsed.header
             actor = actors.Actor.attach(hdr.actor)
             actorID = actor.idnum
             # loop over this message's keywords if we have a dictionary available
-            if not actor.kdict:
+            if isinstance(parsed,ReplySummary):
+                keyErrors = parsed.nKeywords
+            elif not actor.kdict:
                 keyErrors = len(parsed.keywords)
             else:
+                if checked is None:
+                    checked = self.checkKeywords(actor,rawID,parsed.keywords)
                 keyErrors = 0
-                for keyword in parsed.keywords:
+                for keyword,key,valid,values,encoded in checked:
                     keytag = '%s.%s' % (actor.name.lower(),keyword.name.lower())
-                    # look up this keyword's validator in the actor's dictionary
-                    try:
-                        key = actor.kdict[keyword.name]
-                        if key.consume(keyword):
-                            # write this keyword to its own table
-                            try:
-                                keyTable = database.KeyTable.attach(actor,key)
-                                keyTable.record(now,rawID,*tuple(keyword.values))
-                                # update actor key statistics
-                                actor.keyStats[keyword.name] = (
-                                    actor.keyStats.get(keyword.name,0) + 1)
-                            except Exception as e:
-                                log.err('Error writing to %s: %s (see below)'
-                                    % (keytag,e.__class__.__name__))
-                                log.err(str(e))
-                                keyErrors += 1
-                        else:
-                            log.err('Invalid keyword values for %s' % keytag)
-                            keyErrors += 1
-                    except KeyError:
+                    if key is None:
                         log.err('Unknown keyword %s' % keytag)
                         keyErrors += 1
+                    elif not valid:
+                        log.err('Invalid keyword values for %s' % keytag)
+                        keyErrors += 1
+                    else:
+                        # write this keyword to its own table
+                        try:
+                            keyTable = database.KeyTable.attach(actor,key)
+                            keyTable.rollUp(tai,rawID,values)
+                            # does this keyword's storage policy want these values?
+                            if keyTable.policy is None or keyTable.policy.accept(tai,values):
+                                if encoded is None:
+                                    keyTable.record(tai,rawID,*values)
+                                else:
+                                    keyTable.recordEncodedRow(tai,encoded,rawID,*values)
+                            # update actor key statistics
+                            actor.keyStats[keyword.name] = (
+                                actor.keyStats.get(keyword.name,0) + 1)
+                            # update any monitored expressions that watch this keyword
+                            monitor.dispatch(keytag,tai,values)
+                        except Exception as e:
+                            log.err('Error writing to %s: %s (see below)'
+                                % (keytag,e.__class__.__name__))
+                            log.err(str(e))
+                            keyErrors += 1
             # record the reply header fields
             self.replyHdr.record(rawID,actorID,hdr.program,hdr.user,
                 hdr.commandId,hdr.code,keyErrors)
-        except parser.ParseError as e:
-            log.err('%s: unable to parse message: %s' % (self.name,e))
         except actors.ActorException as e:
             log.err('%s: unable to attach actor: %s' % (self.name,e))
+
+class KeywordCache(object):
+    """
+    A bounded LRU cache of validated keyword values and their storage encoding
+
+    Entries are keyed by (actor name,keyword name,raw values) and hold the typed
+    values and, once the keyword's table is attached, their encoding without a
+    raw ID. A size of zero disables the cache. Entries can be looked up and
+    stored from worker threads.
+    """
+    def __init__(self,size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self,key):
+        """
+        Returns the cached entry for key or None
+        """
+        if not self.size:
+            return None
+        with self.lock:
+            try:
+                entry = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self,key,entry):
+        """
+        Caches an entry, discarding the least recently used entry if we are full
+        """
+        if not self.size:
+            return
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+class ShardReceiver(ReplyReceiver):
+    """
+    Receives replies forwarded by the front process of a sharded archiver
+
+    Each line carries the raw ID, TAI timestamp (MJD seconds) and actor ID
+    that the front process assigned when it recorded the reply in reply_raw.
+    """
+    def messagesReceived(self,batch):
+        database.Table.beginBatch()
+        try:
+            for line in batch:
+                self.messageReceived(line)
+        finally:
+            database.Table.endBatch()
+
+    def messageReceived(self,line):
+        try:
+            rawID,tai,actorID,message = line.split(' ',3)
+            rawID,tai,actorID = int(rawID),float(tai),int(actorID)
+        except ValueError:
+            log.err('%s: invalid forwarded reply: %r' % (self.name,line))
+            return
+        actorName = replyActor(message)
+        if actorName is not None:
+            try:
+                actors.Actor.attach(actorName).idnum = actorID
+            except actors.ActorException as e:
+                log.err('%s: unable to attach actor: %s' % (self.name,e))
+                return
+        self.interpretReply(rawID,tai,message)
+
+    def connectionLost(self,reason):
+        ReplyReceiver.connectionLost(self,reason)
+        # our front process has gone away so flush our tables and exit
+        from twisted.internet import reactor
+        if reactor.running:
+            reactor.stop()
+
+class ShardProcess(protocol.ProcessProtocol):
+    """
+    Feeds replies to one worker process of a sharded archiver
+
+    A worker that exits before we stop it is restarted after a delay that
+    doubles with each quick exit. Replies are held while the worker is not
+    running or is not keeping up with its input, up to maxPending bytes, and
+    dropped with an error logged beyond that.
+    """
+    # bytes of replies to hold for a worker that is not accepting them
+    maxPending = 64*2**20
+
+    # seconds to wait before restarting a worker, doubling up to maxDelay
+    initialDelay = 1.
+    maxDelay = 60.
+
+    def __init__(self,index,args=None,env=None):
+        self.index = index
+        self.args = args
+        self.env = env
+        self.running = False
+        self.stopping = False
+        # replies held until the worker can accept them
+        self.pending = collections.deque()
+        self.pendingBytes = 0
+        self.paused = True
+        self.dropped = 0
+        self.delay = ShardProcess.initialDelay
+        # partial output lines from the worker, by file descriptor
+        self.partial = { }
+
+    def start(self):
+        """
+        Starts the worker process
+        """
+        from twisted.internet import reactor
+        if not self.stopping:
+            reactor.spawnProcess(self,self.args[0],self.args,env=self.env)
+
+    def connectionMade(self):
+        print('shard %d: started as PID %d' % (self.index,self.transport.pid))
+        self.running = True
+        self.startedAt = time.time()
+        # the worker's input pipe pauses us when the worker falls behind
+        self.transport.registerProducer(self,True)
+        self.resumeProducing()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        while self.pending and not self.paused:
+            data = self.pending.popleft()
+            self.pendingBytes -= len(data)
+            self.transport.write(data)
+
+    def stopProducing(self):
+        self.paused = True
+
+    def forward(self,rawID,tai,actorID,message):
+        data = ('%d %r %d %s\n' % (rawID,tai,actorID,message)).encode('latin-1')
+        if not self.paused and not self.pending:
+            self.transport.write(data)
+        elif self.pendingBytes + len(data) <= ShardProcess.maxPending:
+            self.pending.append(data)
+            self.pendingBytes += len(data)
+        else:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                log.err('shard %d: dropped %d replies while %d bytes are pending' % (
+                    self.index,self.dropped,self.pendingBytes))
+
+    def stop(self):
+        """
+        Closes this worker's input so that it flushes its tables and exits
+        """
+        self.stopping = True
+        if self.running:
+            # hand over everything we are holding before the worker exits
+            while self.pending:
+                self.transport.write(self.pending.popleft())
+            self.pendingBytes = 0
+            self.transport.closeStdin()
+
+    def childDataReceived(self,childFD,data):
+        # only print complete lines of the worker's output and errors
+        lines = (self.partial.get(childFD,b'') + data).split(b'\n')
+        self.partial[childFD] = lines.pop()
+        for line in lines:
+            print('shard %d: %s' % (self.index,line.decode('latin-1').rstrip('\r')))
+
+    def processEnded(self,reason):
+        self.running = False
+        self.paused = True
+        for childFD,line in self.partial.items():
+            if line:
+                print('shard %d: %s' % (self.index,line.decode('latin-1')))
+        self.partial = { }
+        if self.stopping:
+            print('shard %d: exited' % self.index)
+            return
+        if reason.check(twisted.internet.error.ProcessDone):
+            log.err('shard %d: exited unexpectedly' % self.index)
+        else:
+            log.err('shard %d: exited: %s' % (self.index,reason.getErrorMessage()))
+        # restart quickly after a worker that ran for a while, otherwise back off
+        if time.time() - self.startedAt > ShardProcess.maxDelay:
+            self.delay = ShardProcess.initialDelay
+        print('shard %d: restarting in %.1fs with %d bytes pending' % (
+            self.index,self.delay,self.pendingBytes))
+        from twisted.internet import reactor
+        reactor.callLater(self.delay,self.start)
+        self.delay = min(2*self.delay,ShardProcess.maxDelay)
+
+def replyActor(message):
+    """
+    Returns the actor name field of a reply message or None if it is malformed
+    """
+    fields = message.split(None,3)
+    if len(fields) < 4:
+        return None
+    return fields[2]
+
+"""
+The header fields and keyword count of a reply, which is all that is recorded
+for an actor without a dictionary.
+"""
+ReplyHeader = collections.namedtuple('ReplyHeader','program user commandId actor code')
+ReplySummary = collections.namedtuple('ReplySummary','header nKeywords')
+
+quotedString = re.compile(r'"(?:[^"\\]|\\.)*"')
+
+def replySummary(message):
+    """
+    Returns a ReplySummary without fully parsing a reply, or None if it looks malformed
+    """
+    fields = message.split(None,4)
+    if len(fields) < 4:
+        return None
+    commander,commandId,actor,code = fields[:4]
+    try:
+        commandId = int(commandId)
+        code = messages.ReplyHeader.MsgCode(code)
+    except ValueError:
+        return None
+    program,dot,user = commander.rpartition('.')
+    nKeywords = 0
+    if len(fields) > 4:
+        # ignore any semicolons within quoted values
+        keywords = quotedString.sub('""',fields[4])
+        nKeywords = sum(1 for keyword in keywords.split(';') if keyword.strip())
+    return ReplySummary(ReplyHeader(program,user,commandId,actor,code),nKeywords)
+
+def replyParser():
+    """
+    Returns a reply message parser for the calling thread
+    """
+    try:
+        return threadState.replyParser
+    except AttributeError:
+        threadState.replyParser = parser.ReplyParser()
+        return threadState.replyParser
+
+threadState = threading.local()
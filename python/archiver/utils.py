@@ -6,6 +6,16 @@ def getEnvPath(path):
     path = path.split('/')
     return '/'.join([os.getenv(f[1:]) if (f and f[0] == '$') else f for f in path])
 
+def createTmpPath(path,pid=None):
+    """
+    Creates a new directory, replacing any PID in its path with a process ID
+    """
+    if 'PID' in path:
+        path = path.replace('PID','%d') % (pid or os.getpid())
+    assert not os.path.exists(path)
+    os.makedirs(path)
+    return path
+
 class LevelFileLogObserver(log.FileLogObserver):
 
     def __init__(self, f, level=logging.INFO):
@@ -16,7 +16,7 @@ from twisted.web import resource,server,static
 from twisted.internet import defer
 
 from opscore.utility import html
-from archiver import database,actors
+from archiver import database,actors,protocol,policy
 
 class WebError(Exception):
     pass
@@ -172,8 +172,37 @@ class InfoHandler(WebQuery):
                 len(database.Table.registry)))
         else:
             last = 'No table activity yet'
+        if database.Table.commits:
+            flushes = ('Loaded %d rows from %d table flushes in %d commits ' %
+                (database.Table.loadedRows,database.Table.loads,database.Table.commits) +
+                '(%.1f flushes per commit, largest group %d)' %
+                (float(database.Table.loads)/database.Table.commits,
+                database.Table.largestGroup))
+        else:
+            flushes = 'No table flushes yet'
+        cache = protocol.ReplyReceiver.keywordCache
+        if cache and cache.hits + cache.misses:
+            keywords = ('Keyword cache holds %d of %d entries with %d hits and %d misses ' %
+                (len(cache.entries),cache.size,cache.hits,cache.misses) +
+                '(%.1f%% hit rate)' % (100.*cache.hits/(cache.hits+cache.misses)))
+        else:
+            keywords = 'No keyword cache lookups yet'
+        queries = database.KeyTable.queryCache
+        if queries is not None and queries.budget:
+            queries = ('Query cache holds %d chunks (%.1f of %.1f MB) with ' %
+                (len(queries),queries.bytes/2.**20,queries.budget/2.**20) +
+                '%d hits, %d misses and %d evictions' %
+                (queries.hits,queries.misses,queries.evictions))
+        else:
+            queries = 'Query cache is disabled'
+        stored = ('Storage policies recorded %d and suppressed %d keyword values' %
+            (policy.Policy.stored,policy.Policy.suppressed))
         status = html.Ul(
             html.Li(last),
+            html.Li(flushes),
+            html.Li(keywords),
+            html.Li(queries),
+            html.Li(stored),
             html.Li('Running since %s (%s ago)' % (time.ctime(info.startedAt),elapsed)),
             html.Li('Started by %s using %s' % (info.user,info.commandLine)),
             html.Li('Running as PID %d on %s' % (info.pid,info.host)),
@@ -224,6 +253,31 @@ class InfoHandler(WebQuery):
             actorsTable.append(actorRow)
         content.append(actorsTable)
 
+        content.append(html.H1('Table Buffers'))
+        buffersTable = html.Table()
+        header = html.Tr()
+        header.extend([html.Th(hdr) for hdr in
+            ('name','rows/sec','buffer size','buffered rows','total rows','flushes',
+            'suppressed')])
+        buffersTable.append(header)
+        tables = sorted(database.Table.registry.values(),
+            key=lambda table: table.rowRate or 0,reverse=True)
+        for table in tables:
+            tableRow = html.Tr()
+            tableRow.append(html.Td(table.name))
+            if table.rowRate is None:
+                tableRow.append(html.Td('-'))
+            else:
+                tableRow.append(html.Td('%.3f' % table.rowRate))
+            tableRow.append(html.Td(table.bufferSize))
+            tableRow.append(html.Td(len(table.rowBuffer)))
+            tableRow.append(html.Td(table.nRows))
+            tableRow.append(html.Td(table.nFlushes))
+            tablePolicy = getattr(table,'policy',None)
+            tableRow.append(html.Td('-' if tablePolicy is None else tablePolicy.nSuppressed))
+            buffersTable.append(tableRow)
+        content.append(buffersTable)
+
     def POST(self,request,session,state):
         pass
 
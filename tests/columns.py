@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Unit tests for archiver.columns
+"""
+
+import unittest
+import archiver.columns as columns
+from opscore.protocols import types
+
+class ColumnBufferTests(unittest.TestCase):
+
+    def setUp(self):
+        self.layout = columns.ColumnLayout((types.Int(name='n'),
+            types.String(name='s'),types.Double(name='x')))
+        self.buffer = columns.ColumnBuffer(self.layout)
+
+    def fill(self,rows):
+        for rawID,(tai,values) in enumerate(rows):
+            self.buffer.append(tai,rawID,values)
+
+    def values(self):
+        return [ self.buffer.row(index)[1:] for index in range(len(self.buffer)) ]
+
+    def test00(self):
+        "Rows are stored by column and read back as typed values"
+        self.fill([ (10.,(1,'one',1.5)),(11.,(-2,"it's",-0.5)),(12.,(3,'',0.)) ])
+        self.assertEqual(len(self.buffer),3)
+        self.assertEqual(list(self.buffer.rawID),[ 0,1,2 ])
+        self.assertEqual(list(self.buffer.tai),[ 10.,11.,12. ])
+        self.assertEqual(self.values(),[ [ 1,'one',1.5 ],[ -2,"it's",-0.5 ],[ 3,'',0. ] ])
+        self.assertEqual(self.buffer.nulls,[ None,None,None ])
+
+    def test01(self):
+        "Invalid and missing values are flagged as nulls"
+        invalid = types.InvalidValue
+        self.fill([ (10.,(1,'one',1.5)),(11.,(invalid,'two')),(12.,(3,invalid,2.5)) ])
+        self.assertEqual(self.buffer.nulls[0],bytearray([ 0,1,0 ]))
+        self.assertEqual(self.buffer.nulls[1],bytearray([ 0,0,1 ]))
+        self.assertEqual(self.buffer.nulls[2],bytearray([ 0,1,0 ]))
+        self.assertEqual(self.values(),
+            [ [ 1,'one',1.5 ],[ invalid,'two',invalid ],[ 3,invalid,2.5 ] ])
+
+    def test02(self):
+        "Timestamps are kept monotonic and bisected inclusively"
+        self.fill([ (10.,(1,'a',0.)),(12.,(2,'b',0.)),(11.,(3,'c',0.)),
+            (12.,(4,'d',0.)),(15.,(5,'e',0.)) ])
+        self.assertEqual(list(self.buffer.tai),[ 10.,12.,12.,12.,15. ])
+        self.assertEqual(self.buffer.between(12.,12.),(1,4))
+        self.assertEqual(self.buffer.between(10.,15.),(0,5))
+        self.assertEqual(self.buffer.between(10.5,14.),(1,4))
+        self.assertEqual(self.buffer.between(0.,9.),(0,0))
+        self.assertEqual(self.buffer.between(16.,20.),(5,5))
+
+    def test03(self):
+        "A row that cannot be stored leaves the buffer unchanged"
+        self.fill([ (10.,(1,'one',1.5)) ])
+        self.assertRaises(ValueError,self.buffer.append,11.,1,
+            (2,'two','not a number'))
+        self.assertEqual(len(self.buffer),1)
+        self.assertEqual(self.buffer.text[1],bytearray(b'one'))
+        self.assertEqual([ len(column) for column in self.buffer.columns ],[ 1,1,1 ])
+        self.buffer.append(12.,1,(types.InvalidValue,'three',2.5))
+        self.assertEqual(self.values(),[ [ 1,'one',1.5 ],[ types.InvalidValue,'three',2.5 ] ])
+
+    def test04(self):
+        "Truncation discards trailing rows"
+        self.fill([ (10.,(1,'one',1.5)),(11.,(types.InvalidValue,'two',2.5)),
+            (12.,(3,'three',3.5)) ])
+        self.buffer.truncate(2)
+        self.assertEqual(len(self.buffer),2)
+        self.assertEqual(list(self.buffer.tai),[ 10.,11. ])
+        self.assertEqual(self.buffer.text[1],bytearray(b'onetwo'))
+        self.assertEqual(self.buffer.nulls[0],bytearray([ 0,1 ]))
+        self.buffer.truncate(0)
+        self.assertEqual(len(self.buffer),0)
+        self.assertEqual(self.buffer.text[1],bytearray())
+        self.assertEqual(self.buffer.between(0.,20.),(0,0))
+
+    @unittest.skipIf(columns.numpy is None,'numpy is not available')
+    def test05(self):
+        "Batches return stored values without building typed values"
+        invalid = types.InvalidValue
+        self.fill([ (10.,(1,'one',1.5)),(11.,(invalid,invalid,invalid)),(12.,(3,'three',3.5)) ])
+        batch = columns.bufferedBatch(self.buffer,1,3)
+        self.assertEqual(len(batch),2)
+        self.assertEqual(self.layout.plain,[ True,True,True ])
+        self.assertEqual(batch.values(0),[ None,3 ])
+        self.assertEqual(batch.values(1),[ None,'three' ])
+        self.assertEqual(batch.values(2),[ None,3.5 ])
+        self.assertEqual(batch.typedValues(0),[ invalid,3 ])
+        self.assertEqual([ row[1:] for row in batch ],[ [ invalid,invalid,invalid ],[ 3,'three',3.5 ] ])
+        self.assertEqual(columns.bufferedBatch(self.buffer,0,0).timestamps(),[ ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""
+Unit tests for archiver.database
+"""
+
+import unittest
+import struct
+from twisted.internet import defer
+import archiver.database as database
+import archiver.columns as columns
+from opscore.protocols import types
+
+class BinaryCopyTests(unittest.TestCase):
+
+    def setUp(self):
+        self.vtypes = (types.Long(name='id'),types.UInt(name='n'),
+            types.Double(name='x'),types.Float(name='y'),types.String(name='s'))
+        self.encode = database.rowEncoder(self.vtypes,binary=True)
+
+    def decode(self,stream):
+        "Decodes a binary COPY stream into a list of tuples of raw field bytes"
+        header = database.binaryHeader
+        self.assertEqual(stream[:len(header)],header)
+        offset,tuples = len(header),[ ]
+        while True:
+            nFields, = struct.unpack_from('!h',stream,offset)
+            offset += 2
+            if nFields == -1:
+                break
+            fields = [ ]
+            for field in range(nFields):
+                size, = struct.unpack_from('!i',stream,offset)
+                offset += 4
+                if size < 0:
+                    fields.append(None)
+                else:
+                    fields.append(stream[offset:offset+size])
+                    offset += size
+            tuples.append(fields)
+        self.assertEqual(offset,len(stream))
+        return tuples
+
+    def test00(self):
+        "Binary COPY header and trailer"
+        self.assertEqual(database.binaryHeader[:11],b'PGCOPY\n\xff\r\n\x00')
+        self.assertEqual(database.binaryHeader[11:],b'\x00'*8)
+        self.assertEqual(self.decode(database.binaryHeader + database.binaryTrailer),[ ])
+
+    def test01(self):
+        "Binary COPY round trip"
+        stream = (database.binaryHeader +
+            self.encode((123456789012,7,1.5,-0.25,"it's")) +
+            self.encode((-1,0x80000001,0.,2.,u'\u00b0C')) +
+            database.binaryTrailer)
+        (row1,row2) = self.decode(stream)
+        self.assertEqual(struct.unpack('!q',row1[0])[0],123456789012)
+        self.assertEqual(struct.unpack('!i',row1[1])[0],7)
+        self.assertEqual(struct.unpack('!d',row1[2])[0],1.5)
+        self.assertEqual(struct.unpack('!f',row1[3])[0],-0.25)
+        self.assertEqual(row1[4].decode('utf-8'),"it's")
+        self.assertEqual(struct.unpack('!q',row2[0])[0],-1)
+        # UInt values use the MSB as a sign bit
+        self.assertEqual(struct.unpack('!i',row2[1])[0],-1)
+        self.assertEqual(row2[4].decode('utf-8'),u'\u00b0C')
+
+    def test02(self):
+        "Binary COPY nulls for invalid and missing values"
+        invalid = types.InvalidValue
+        (row,) = self.decode(database.binaryHeader +
+            self.encode((1,invalid,2.)) + database.binaryTrailer)
+        self.assertEqual(len(row),len(self.vtypes))
+        self.assertEqual(row[1],None)
+        self.assertEqual(row[3:],[ None,None ])
+        self.assertEqual(struct.unpack('!d',row[2])[0],2.)
+
+    def test03(self):
+        "Unsupported storage types are rejected"
+        vtype = types.Double(name='x')
+        vtype.storage = 'blob'
+        self.assertRaises(database.DatabaseException,
+            database.rowEncoder,(vtype,),True)
+
+class ConnectionPool(object):
+    "Records each query and returns up to its limit of the (rawID,row) pairs it is given"
+
+    def __init__(self,pairs):
+        self.pairs = pairs
+        self.queries = [ ]
+
+    def runInteraction(self,interaction,sql,vtypes):
+        self.queries.append(sql)
+        limit = int(sql.rsplit('limit ',1)[1].rstrip(';'))
+        return defer.succeed(self.pairs[:limit])
+
+class PageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = database.Table.registry,database.Table.connectionPool
+        rawTable = database.Table.__new__(database.Table)
+        rawTable.name,rawTable.columnNames = 'reply_raw',[ 'id','tai','msg' ]
+        database.Table.registry = { 'reply_raw': rawTable }
+        database.Table.connectionPool = None
+        self.table = database.KeyTable.__new__(database.KeyTable)
+        self.table.name,self.table.columnNames = 'tcc__axepos',[ 'raw_id','az' ]
+        self.table.columnFinalTypes = (types.Long(name='raw_id'),types.Double(name='az'))
+        self.table.prepareQueries()
+        # buffered rows with raw IDs 10-14 at TAI 100-104
+        self.table.rowBuffer = columns.ColumnBuffer(
+            columns.ColumnLayout((types.Double(name='az'),)))
+        for rawID in range(10,15):
+            self.table.rowBuffer.append(90.+rawID,rawID,(float(rawID),))
+
+    def tearDown(self):
+        database.Table.registry,database.Table.connectionPool = self.saved
+
+    def page(self,begin,end,bound,ascending,limit):
+        result = [ ]
+        self.table.pageByDate(begin,end,bound,ascending,limit).addCallback(result.append)
+        return [ rawID for rawID,row in result[0] ]
+
+    def test00(self):
+        "Page tokens round trip and reject garbage"
+        token = database.encodePageToken(5e9+0.125,5e9+3600.5,123456789012,True)
+        for char in '=+/':
+            self.assertFalse(char in token)
+        self.assertEqual(database.decodePageToken(token),(5e9+0.125,5e9+3600.5,123456789012,True))
+        token = database.encodePageToken(0.,1.,0,False)
+        self.assertEqual(database.decodePageToken(token),(0.,1.,0,False))
+        for token in ('','not a token!',token[:-2],token + 'AAAA',u'\u00e9t\u00e9'):
+            self.assertRaises(database.DatabaseException,database.decodePageToken,token)
+
+    def test01(self):
+        "Pages end with a token unless they are the last and never split a raw ID"
+        pairs = [ (1,'a'),(2,'b'),(2,'c'),(3,'d') ]
+        self.assertEqual(database.pageResult(pairs,0.,1.,True,4),([ 'a','b','c','d' ],None))
+        values,token = database.pageResult(pairs,0.,1.,True,3)
+        self.assertEqual(values,[ 'a','b','c' ])
+        self.assertEqual(database.decodePageToken(token),(0.,1.,2,True))
+        values,token = database.pageResult(pairs,0.,1.,False,2)
+        self.assertEqual(values,[ 'a' ])
+        self.assertEqual(database.decodePageToken(token),(0.,1.,1,False))
+        self.assertEqual(database.pageResult([ ],0.,1.,True,2),([ ],None))
+
+    def test02(self):
+        "Buffered pages continue after their bound in either order"
+        self.assertEqual(self.page(100.5,104.,None,False,2),[ 14,13 ])
+        self.assertEqual(self.page(100.5,104.,13,False,2),[ 12,11 ])
+        self.assertEqual(self.page(100.5,104.,11,False,2),[ ])
+        self.assertEqual(self.page(100.5,104.,None,True,2),[ 11,12 ])
+        self.assertEqual(self.page(100.5,104.,12,True,5),[ 13,14 ])
+        self.assertEqual(self.page(100.5,104.,14,True,5),[ ])
+        # date range boundaries are inclusive for buffered rows
+        self.assertEqual(self.page(100.5,103.,None,True,5),[ 11,12,13 ])
+        self.assertEqual(self.page(100.5,102.5,None,False,5),[ 12,11 ])
+
+    def test03(self):
+        "Pages combine database rows before the buffer without duplicates"
+        pool = database.Table.connectionPool = ConnectionPool([ (9,[ ]),(8,[ ]) ])
+        self.assertEqual(self.page(50.,104.,None,False,3),[ 14,13,12 ])
+        self.assertEqual(pool.queries,[ ])
+        self.assertEqual(self.page(50.,104.,12,False,3),[ 11,10,9 ])
+        self.assertTrue(pool.queries[-1].endswith(
+            'raw.tai > 50.0 and raw.tai <= 104.0 and key.raw_id < 12 order by key.raw_id desc limit 1;'))
+        self.assertTrue(' and key.raw_id < 10' in pool.queries[-1])
+        pool.pairs = [ (8,[ ]),(9,[ ]) ]
+        self.assertEqual(self.page(50.,104.,5,True,3),[ 8,9,10 ])
+        self.assertTrue(pool.queries[-1].endswith(
+            'key.raw_id > 5 order by key.raw_id limit 3;'))
+        # a range that starts within the buffer needs no query
+        nQueries = len(pool.queries)
+        self.assertEqual(self.page(101.,104.,None,True,5),[ 11,12,13,14 ])
+        self.assertEqual(len(pool.queries),nQueries)
+        # without a database only buffered rows are paged
+        database.Table.connectionPool = None
+        self.assertEqual(self.page(50.,104.,12,False,3),[ 11,10 ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Unit tests for archiver.decimate
+"""
+
+import unittest
+import math
+import archiver.decimate as decimate
+
+class DecimateTests(unittest.TestCase):
+
+    def setUp(self):
+        self.points = [ (x,math.sin(x/10.)) for x in range(1000) ]
+
+    def test00(self):
+        "LTTB keeps short series and the end points"
+        self.assertEqual(decimate.lttb(self.points[:5],10),self.points[:5])
+        reduced = decimate.lttb(self.points,50)
+        self.assertEqual(len(reduced),50)
+        self.assertEqual(reduced[0],self.points[0])
+        self.assertEqual(reduced[-1],self.points[-1])
+        self.assertEqual(reduced,sorted(reduced))
+
+    def test01(self):
+        "LTTB selects a spike"
+        points = [ (x,0.) for x in range(100) ]
+        points[42] = (42,10.)
+        self.assertTrue((42,10.) in decimate.lttb(points,10))
+
+    def test02(self):
+        "Min/max per bucket"
+        reduced = decimate.minmax(self.points,20)
+        self.assertTrue(len(reduced) <= 40)
+        self.assertEqual(reduced,sorted(reduced))
+        ys = [ y for x,y in self.points ]
+        self.assertEqual(min(y for x,y in reduced),min(ys))
+        self.assertEqual(max(y for x,y in reduced),max(ys))
+        self.assertEqual(decimate.minmax([ ],10),[ ])
+
+    def test03(self):
+        "Streaming points in any order"
+        reducer = decimate.BucketReducer(0,999,10)
+        for x,y in reversed(self.points):
+            reducer.add(x,y)
+        reducer.add(500,None)
+        reducer.add(1000,5.)
+        self.assertEqual(reducer.nPoints,1000)
+        self.assertEqual(reducer.points(),decimate.minmax(self.points,10))
+
+    def test04(self):
+        "NaN and infinite values are skipped"
+        nan,inf = float('nan'),float('inf')
+        reducer = decimate.BucketReducer(0,9,1)
+        for x,y in enumerate((nan,3.,nan,-inf,-1.,inf,2.,nan)):
+            reducer.add(x,y)
+        self.assertEqual(reducer.nPoints,3)
+        self.assertEqual(reducer.points(),[ (1,3.),(4,-1.) ])
+        reducer = decimate.BucketReducer(0,9,1)
+        reducer.add(0,nan)
+        self.assertEqual(reducer.nPoints,0)
+        self.assertEqual(reducer.points(),[ ])
+        points = [ (x,nan if x % 3 else float(x)) for x in range(30) ]
+        self.assertEqual(decimate.minmax(points,2),[ (0,0.),(12,12.),(15,15.),(27,27.) ])
+
+if __name__ == '__main__':
+    unittest.main()
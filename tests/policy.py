@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Unit tests for archiver.policy
+"""
+
+import unittest
+import archiver.policy as policy
+
+class PolicyTests(unittest.TestCase):
+
+    def tearDown(self):
+        policy.init('')
+
+    def accepted(self,keyPolicy,samples):
+        return [ keyPolicy.accept(tai,values) for tai,values in samples ]
+
+    def test00(self):
+        "Keywords without a rule are always recorded"
+        policy.init('tcc.axePos=onchange')
+        self.assertEqual(policy.forKey('tcc','other'),None)
+        self.assertEqual(policy.forKey('mcp','axePos'),None)
+        policy.init('tcc.*=always')
+        self.assertEqual(policy.forKey('tcc','axePos'),None)
+
+    def test01(self):
+        "Keyword rules take precedence over actor rules"
+        policy.init('TCC.*=every:10, tcc.axepos=onchange')
+        self.assertTrue(isinstance(policy.forKey('tcc','axePos'),policy.OnChange))
+        self.assertTrue(isinstance(policy.forKey('tcc','other'),policy.Every))
+
+    def test02(self):
+        "Invalid rules"
+        self.assertRaises(policy.PolicyError,lambda: policy.init('tcc.axePos'))
+        self.assertRaises(policy.PolicyError,lambda: policy.init('tcc=onchange'))
+        self.assertRaises(policy.PolicyError,lambda: policy.init('tcc.x=sometimes'))
+        self.assertRaises(policy.PolicyError,lambda: policy.init('tcc.x=onchange:1'))
+        self.assertRaises(policy.PolicyError,lambda: policy.init('tcc.x=every'))
+        self.assertRaises(policy.PolicyError,lambda: policy.init('tcc.x=deadband:abc'))
+        self.assertRaises(policy.PolicyError,lambda: policy.init('tcc.x=deadband:-1'))
+
+    def test03(self):
+        "Store on change"
+        keyPolicy = policy.OnChange()
+        self.assertEqual(self.accepted(keyPolicy,
+            ((0,(1,'a')),(1,(1,'a')),(2,(1,'b')),(3,(1,'b')),(4,(1,'a')))),
+            [True,False,True,False,True])
+        self.assertEqual(keyPolicy.nSuppressed,2)
+
+    def test04(self):
+        "Store beyond an absolute deadband"
+        keyPolicy = policy.Deadband('0.5')
+        self.assertEqual(self.accepted(keyPolicy,
+            ((0,(1.0,)),(1,(1.4,)),(2,(0.6,)),(3,(1.6,)),(4,(1.6,2.0)))),
+            [True,False,False,True,True])
+
+    def test05(self):
+        "Store beyond a relative deadband"
+        keyPolicy = policy.Deadband('10%')
+        self.assertEqual(self.accepted(keyPolicy,
+            ((0,(100,'ok')),(1,(109,'ok')),(2,(111,'ok')),(3,(111,'bad')))),
+            [True,False,True,True])
+        self.assertEqual(policy.Deadband('10%%').band,0.1)
+
+    def test06(self):
+        "Store at most every N seconds"
+        keyPolicy = policy.Every('10')
+        self.assertEqual(self.accepted(keyPolicy,
+            ((0,(1,)),(5,(2,)),(10,(3,)),(19,(4,)),(20.5,(5,)))),
+            [True,False,True,False,True])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Unit tests for archiver.protocol
+"""
+
+import unittest
+import sys
+import os,os.path
+import tempfile
+import shutil
+
+from twisted.internet import reactor
+
+import archiver.protocol as protocol
+
+# a stand-in for a sharded archiveServer worker that creates its tmp path the
+# same way and then reads replies until its input is closed
+worker = """
+import sys
+from archiver.utils import createTmpPath
+path = createTmpPath(sys.argv[sys.argv.index('--tmp-path')+1])
+sys.stdout.write('ready %s\\n' % path)
+sys.stdout.flush()
+sys.stdin.read()
+"""
+
+class Shard(protocol.ShardProcess):
+
+    def __init__(self,*args):
+        protocol.ShardProcess.__init__(self,*args)
+        self.ready = [ ]
+
+    def childDataReceived(self,childFD,data):
+        protocol.ShardProcess.childDataReceived(self,childFD,data)
+        if data.startswith(b'ready '):
+            self.ready.append(data[6:].strip())
+            if len(self.ready) == 1:
+                # kill the first worker so that it is restarted
+                self.transport.signalProcess('KILL')
+            else:
+                self.stop()
+
+    def processEnded(self,reason):
+        protocol.ShardProcess.processEnded(self,reason)
+        if self.stopping:
+            reactor.stop()
+
+class ShardTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpPath = tempfile.mkdtemp(prefix='shardTest')
+        self.initialDelay = protocol.ShardProcess.initialDelay
+        protocol.ShardProcess.initialDelay = 0.1
+
+    def tearDown(self):
+        protocol.ShardProcess.initialDelay = self.initialDelay
+        shutil.rmtree(self.tmpPath)
+
+    def test00(self):
+        "A killed worker is restarted with a new tmp path"
+        args = [ sys.executable,'-c',worker,
+            '--tmp-path',os.path.join(self.tmpPath,'shard0-PID') ]
+        shard = Shard(0,args,os.environ)
+        reactor.callWhenRunning(shard.start)
+        timeout = reactor.callLater(30,reactor.stop)
+        reactor.run()
+        self.assertTrue(timeout.active(),'worker was not restarted')
+        timeout.cancel()
+        self.assertEqual(len(shard.ready),2)
+        self.assertNotEqual(shard.ready[0],shard.ready[1])
+        self.assertEqual(len(os.listdir(self.tmpPath)),2)
+
+if __name__ == '__main__':
+    unittest.main()